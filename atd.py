@@ -1,21 +1,36 @@
 import base64
+import cStringIO
 import datetime
+import gzip
+import hashlib
+import httplib
+import json
 from optparse import OptionParser
 import os
+import Queue
 import rfc822
 import re
 import shlex
 import shutil
+import socket
 import string
 import struct
 import sys
+import threading
 import time
+import urllib
 import urllib2
-from xml.etree.ElementTree import ElementTree
+import urlparse
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+#strptime imports this lazily, which isn't thread safe, and Movies are built
+#on several threads at once
+import _strptime
 
 
 from pkg.BeautifulSoup import BeautifulSoup
-import imdb
 from pkg.optparse_fmt import IndentedHelpFormatterWithNL
 import pkg.y_serial_v052 as y_serial
 
@@ -54,11 +69,69 @@ def date_filter(obj_list, dt, date_attrib, after = True, include_none=True):
 
     return objects
 
+def movie_rows(db, title=None, mdate=None, tdate=None, include_none=True):
+    ''' Returns y_serial Row handles for the newest copy of every movie in the
+        database without unpickling any of them.  Each row has the
+        MOVIE_COLUMNS as attributes (release_date as a datetime) and
+        row.load() returns its Movie.
+
+        The rows can be narrowed down in SQLite to movies whose title contains
+        "title", that are released on or after "mdate" (or have no release
+        date if include_none is set), or that have a trailer newer than
+        "tdate".
+    '''
+    subquery = 'WHERE apple_id IS NOT NULL'
+    parlist = []
+    if title:
+        subquery += ' AND title GLOB ?'
+        parlist.append('*%s*' % title)
+    if mdate:
+        if include_none:
+            subquery += ' AND (release_date >= ? OR release_date IS NULL)'
+        else:
+            subquery += ' AND release_date >= ?'
+        parlist.append(datetime.datetime.strftime(mdate, RELEASE_DATE_FORMAT))
+    if tdate:
+        subquery += ' AND trailer_date > ?'
+        parlist.append(datetime.datetime.strftime(tdate, TRAILER_DATE_FORMAT))
+    #Only the newest row for each movie, looked up through the apple_id index
+    subquery += ' AND kid = (SELECT MAX(kid) FROM movies AS newest WHERE newest.apple_id = movies.apple_id)'
+
+    rows = db.rowsub(subquery, parlist, MOVIE_COLUMNS, 'movies')
+    for row in rows:
+        if row.release_date:
+            row.release_date = datetime.datetime.strptime(row.release_date, RELEASE_DATE_FORMAT)
+    return rows
+
+def load_movies(rows):
+    ''' Unpickle the Movies for a list of movie_rows().
+    '''
+    movies = [row.load() for row in rows]
+    return [movie for movie in movies if isinstance(movie, Movie)]
+
 def get_movies_from_db(db):
     ''' Retrieve all Movie objects from database.
     '''
-    movies = [x[2] for x in db.selectdic("*", 'movies').values() if isinstance(x[2], Movie)]
-    return movies
+    return load_movies(movie_rows(db))
+
+def select_movies(db, title=None, skip_ids=()):
+    ''' Retrieve the Movie objects that pass our --mdate and --tdate filters,
+        optionally only those whose title contains "title".  Movies whose
+        apple_id is in skip_ids are left out.
+
+        Both filters are done by SQLite, so only the matching Movies are
+        unpickled.
+    '''
+    rows = movie_rows(db, title, options.mdatelimit, options.tdatelimit)
+    return load_movies([row for row in rows if row.apple_id not in skip_ids])
+
+def pending_movies(db, skip_ids=()):
+    ''' Retrieve the stored Movie objects that are still waiting on a rating
+        from IMDb, other than those whose apple_id is in skip_ids.
+    '''
+    rows = movie_rows(db)
+    return load_movies([row for row in rows
+                        if row.imdb_pending and row.apple_id not in skip_ids])
 
 def sanitized_filename(filename, file_location=None):
     ''' Used to sanitize text for use as a filename.  If file_location isn't
@@ -96,36 +169,63 @@ def sanitized_filename(filename, file_location=None):
     else:
         return fn
 
-def move_file(s, d):
+def move_file(s, d, digest=None):
     ''' Try to safely move a file from s to d.  If filename already exists, and
         file contents are different (as determined by hash_file()) we try
         appending an integer to filename.
 
         Argument d should include destination filename as well as path.
 
+        If we have a content_index, "digest" (the hash_file() of s, worked out
+        if not given) is first looked up there, and if we already have the
+        same file under any name we keep that one and delete s.  The path the
+        file ends up at is recorded in the index.
     '''
+    index = content_index
+    if index:
+        if digest is None:
+            digest = hash_file(s)
+        if ContentIndex.usable(digest):
+            existing = index.lookup(digest)
+            if existing:
+                #We already have this file, so just delete source
+                os.remove(s)
+                return existing
+        else:
+            #hash_file() couldn't give us a real hash for this one
+            index = None
 
     if not os.path.isfile(d):
         #Filename doesn't exist at destination, so move it...
         shutil.move(s, d)
+        if index:
+            index.add(d, digest)
         return d
     else:
         #Filename exists, so lets see if it's the same file
-        source_hash = hash_file(s)
+        if digest is None:
+            digest = hash_file(s)
+
+        dest_hash = index and index.hash_of(d)
+        if not dest_hash:
+            dest_hash = hash_file(d)
+            if index:
+                index.add(d, dest_hash)
 
-        if source_hash == hash_file(d):
+        if digest == dest_hash:
             #It is the same file, so just delete source
             os.remove(s)
             return d
 
         #Different file with same filename so try up to 10 filenames before failing
+        base, ext = os.path.splitext(d)
         for i in range(10):
-            d = "%s%s%s" % (os.path.splitext(d)[0],
-                                      "." + str(i),
-                                      os.path.splitext(d)[1])
+            d = "%s%s%s" % (base, "." + str(i), ext)
 
             if not os.path.isfile(d):
                 shutil.move(s, d)
+                if index:
+                    index.add(d, digest)
                 return d
 
         raise NameError("Can't find valid filename for %s" % os.path.basename(s))
@@ -173,6 +273,109 @@ def _options():
     parser.add_option("--flush",
                       help="Deletes all stored state information, which means that atd will no longer remember which trailers it has already downloaded.",
                       action="store_true")
+    parser.add_option("--probe-workers",
+                      dest="probe_workers",
+                      metavar="N",
+                      help="Number of concurrent connections used when checking which resolutions are available for trailers. (default: %default)",
+                      type="int",
+                      default=8)
+    parser.add_option("--build-workers",
+                      dest="build_workers",
+                      metavar="N",
+                      help="Number of movies to fetch info for at the same time when refreshing from Apple.  Use 1 to fetch them one at a time. (default: %default)",
+                      type="int",
+                      default=4)
+    parser.add_option("--buffer-size",
+                      dest="buffer_size",
+                      metavar="KB",
+                      help="Size of the chunks, in kilobytes, that trailers are written to disk in while downloading. (default: %default)",
+                      type="int",
+                      default=256)
+    parser.add_option("--segments",
+                      dest="segments",
+                      metavar="N",
+                      help="Download large trailers over N connections at once, each fetching a different part of the file.  Only used when the server supports it. (default: %default)",
+                      type="int",
+                      default=1)
+    parser.add_option("--concurrent",
+                      dest="concurrent",
+                      metavar="N",
+                      help="Number of trailers to download at the same time. (default: %default)",
+                      type="int",
+                      default=2)
+    parser.add_option("--per-host",
+                      dest="per_host",
+                      metavar="N",
+                      help="Maximum number of trailers to download from any one server at the same time. (default: %default)",
+                      type="int",
+                      default=2)
+    parser.add_option("--limit-rate",
+                      dest="limit_rate",
+                      metavar="KB",
+                      help="Limit the combined speed of all downloads to this many kilobytes per second.  0 means no limit. (default: %default)",
+                      type="int",
+                      default=0)
+    parser.add_option("--db-pragma",
+                      dest="db_pragmas",
+                      metavar="NAME=VALUE",
+                      help="Set a SQLite PRAGMA on the database connection, overriding our defaults of %s.  Can be used more than once." % ', '.join(['%s=%s' % x for x in sorted(DB_PRAGMAS.items())]),
+                      action="append",
+                      default=[])
+    parser.add_option("--db-codec",
+                      dest="db_codec",
+                      metavar="NAME[:LEVEL]",
+                      help="How movies are compressed when saved to the database: %s, optionally with a compression level for zlib.  Movies already saved are still read whatever they were saved with. (default: %%default)" % ', '.join(sorted(y_serial.codecs)),
+                      default="zlib:%s" % y_serial.compress_level)
+    parser.add_option("--benchmark",
+                      dest="benchmark",
+                      metavar="WHAT",
+                      help="Time the database codecs on the movies in the database, or hash_file() on the trailers downloaded, and exit.  WHAT can be: codecs, hash",
+                      type="choice",
+                      choices=['codecs', 'hash'])
+    parser.add_option("--probe-ahead",
+                      dest="probe_ahead",
+                      metavar="N",
+                      help="When looking for a movie's other trailers, also check for this many trailers newer than the one Apple lists. (default: %default)",
+                      type="int",
+                      default=2)
+    parser.add_option("--probe-ttl",
+                      dest="probe_ttl",
+                      metavar="DAYS",
+                      help="How long to remember that a trailer url exists before checking it again. (default: %default)",
+                      type="float",
+                      default=6)
+    parser.add_option("--probe-miss-ttl",
+                      dest="probe_miss_ttl",
+                      metavar="DAYS",
+                      help="How long to remember that a trailer url doesn't exist before checking it again. (default: %default)",
+                      type="float",
+                      default=1)
+    parser.add_option("--imdb-workers",
+                      dest="imdb_workers",
+                      metavar="N",
+                      help="Number of movies to look up ratings for on IMDb at the same time. (default: %default)",
+                      type="int",
+                      default=2)
+    parser.add_option("--imdb-ttl",
+                      dest="imdb_ttl",
+                      metavar="DAYS",
+                      help="How long to remember a rating found on IMDb for a movie Apple lists as not yet rated before asking IMDb again. (default: %default)",
+                      type="float",
+                      default=7)
+    parser.add_option("--imdb-miss-ttl",
+                      dest="imdb_miss_ttl",
+                      metavar="DAYS",
+                      help="How long to remember that IMDb had no rating for a movie before asking again. (default: %default)",
+                      type="float",
+                      default=1)
+    parser.add_option("--incremental",
+                      dest="incremental",
+                      help="Only update movies whose information in Apple's listing has changed since the last run.",
+                      action="store_true")
+    parser.add_option("--pipeline",
+                      dest="pipeline",
+                      help="Start downloading as soon as the first movies are read from Apple instead of waiting until every movie has been checked.",
+                      action="store_true")
 
     (options, args) = parser.parse_args()
 
@@ -194,6 +397,64 @@ def _options():
         print "Invalid respoution specified for --respref"
         sys.exit()
 
+    if options.probe_workers < 1:
+        print "--probe-workers must be at least 1"
+        sys.exit()
+
+    if options.build_workers < 1:
+        print "--build-workers must be at least 1"
+        sys.exit()
+
+    if options.buffer_size < 1:
+        print "--buffer-size must be at least 1"
+        sys.exit()
+
+    if options.segments < 1:
+        print "--segments must be at least 1"
+        sys.exit()
+
+    if options.concurrent < 1 or options.per_host < 1:
+        print "--concurrent and --per-host must be at least 1"
+        sys.exit()
+
+    if options.limit_rate < 0:
+        print "--limit-rate can't be negative"
+        sys.exit()
+
+    if options.probe_ahead < 0:
+        print "--probe-ahead can't be negative"
+        sys.exit()
+
+    if options.probe_ttl < 0 or options.probe_miss_ttl < 0:
+        print "--probe-ttl and --probe-miss-ttl can't be negative"
+        sys.exit()
+
+    if options.imdb_workers < 1:
+        print "--imdb-workers must be at least 1"
+        sys.exit()
+
+    if options.imdb_ttl < 0 or options.imdb_miss_ttl < 0:
+        print "--imdb-ttl and --imdb-miss-ttl can't be negative"
+        sys.exit()
+
+    pragmas = {}
+    for pragma in options.db_pragmas:
+        match = re.match(r"^(?P<name>\w+)=(?P<value>[\w-]+)$", pragma)
+        if not match:
+            print "Invalid --db-pragma %s.  Please use NAME=VALUE." % pragma
+            sys.exit()
+        pragmas[match.group('name')] = match.group('value')
+    options.db_pragmas = pragmas
+
+    match = re.match(r"^(?P<name>\w+)(:(?P<level>\d))?$", options.db_codec)
+    if not match or match.group('name') not in y_serial.codecs:
+        print "Invalid --db-codec %s.  Please use one of: %s" % (options.db_codec, ', '.join(sorted(y_serial.codecs)))
+        sys.exit()
+    if match.group('level'):
+        options.db_codec = (match.group('name'), int(match.group('level')))
+    else:
+        options.db_codec = (match.group('name'), None)
+
     return options
 
 def sync_movie(old_movie, new_movie):
@@ -208,12 +469,21 @@ def sync_movie(old_movie, new_movie):
     replace_attribs = ['title', 'runtime', 'mpaa', 'release_date', 'description',
                        'apple_genre', 'studio', 'director', 'cast']
 
+    #...except a rating that's still to be looked up on IMDb, which shouldn't
+    #wipe out one we've already found
+    if new_movie.imdb_pending:
+        replace_attribs.remove('mpaa')
+    synced_movie.imdb_pending = new_movie.imdb_pending
+
     #...so we just use the info from new_movie without regard to it's value in old_movie
     for attrib in replace_attribs:
         setattr(synced_movie, attrib, getattr(new_movie, attrib))
         if getattr(old_movie, attrib) != getattr(new_movie, attrib):
             print "Updated: %s ==> %s" % (getattr(old_movie, attrib), getattr(new_movie, attrib))
 
+    #Remember what the listing looked like so --incremental can tell if it changes
+    synced_movie.xml_digest = new_movie.xml_digest
+
     #If we have any new urls in the following lists we add them
     for url in new_movie.poster_url:
         if url not in old_movie.poster_url:
@@ -254,18 +524,9 @@ def sync_movie(old_movie, new_movie):
 
     return synced_movie
 
-def download_trailers(db, res):
-    ''' Build a list of movies and then call the appropriate download method
-        on each.
+def filter_movies(movies):
+    ''' Applies the --mdate and --tdate filters to a list of movies.
     '''
-    if options.redownload:
-        #User specified a title string to download, so build our list of movies
-        #using that
-        movies = fetch_by_movie_title(options.redownload, db)
-    else:
-        #Get all movies
-        movies = get_movies_from_db(db)
-
     if options.mdatelimit:
         #User has a movie date filter set, so filter our list of movies
         movies = date_filter(movies, options.mdatelimit, 'release_date')
@@ -278,25 +539,149 @@ def download_trailers(db, res):
                     trailer_date_filtered.append(movie)
                     break
         movies = trailer_date_filtered
+    return movies
+
+def run_pipeline(db, res):
+    ''' Does the work of update_movies() and download_trailers() as
+        overlapping stages instead of one after the other.  Movies read from
+        Apple's xml flow through bounded queues to have their trailers'
+        resolutions checked, then get saved to our database, then get
+        their trailers downloaded, so the first download starts as soon as
+        the first movie makes it through.
+
+        Once Apple's list has been worked through, movies we already had in
+        the database that weren't in it are downloaded as usual.
+    '''
+    depth = options.build_workers * 2
+    seen = set()
+
+    scheduler = DownloadScheduler(options.concurrent, options.per_host,
+                                  options.limit_rate * 1024,
+                                  on_complete=lambda movie: persist_movie(movie, db, commit=True))
+    scheduler.start()
+
+    def parse():
+        movies_xml = _fetchxml(db)
+        if movies_xml:
+            _thread_map(lambda movie_xml: _build_movie(movie_xml, db),
+                        movies_xml, options.build_workers,
+                        callback=lambda index, movie: prober.put(movie))
+
+    def probe(movie):
+        fetch_available_res(movie.trailers.values())
+        persister.put(movie)
+
+    #Movies still waiting on a rating from IMDb are only downloaded once
+    #they have it, so it's there for the rename mask
+    enricher = ImdbEnricher(db)
+    enricher.start()
+
+    def persist(movie):
+        movie = persist_movie(movie, db, commit=True)
+        seen.add(movie.apple_id)
+        if filter_movies([movie]):
+            enricher.add(movie, callback=lambda movie: scheduler.add(movie, res, saved=True))
+        else:
+            enricher.add(movie)
+
+    prober = WorkerPool(probe, options.build_workers, depth)
+    #only one thread saves to the database
+    persister = WorkerPool(persist, 1, depth)
+    prober.start()
+    persister.start()
+
+    parser = threading.Thread(target=parse)
+    parser.setDaemon(True)
+    parser.start()
+    wait_threads([parser])
+    prober.join()
+    persister.join()
+
+    leftovers = select_movies(db, skip_ids=seen)
+    trailers = []
+    for movie in leftovers:
+        trailers.extend(movie.trailers.values())
+    fetch_available_res(trailers)
+    for movie in leftovers:
+        seen.add(movie.apple_id)
+        enricher.add(movie, callback=lambda movie: scheduler.add(movie, res))
+
+    #Movies from earlier runs that never got their rating get another try
+    for movie in pending_movies(db, skip_ids=seen):
+        enricher.add(movie)
+
+    enricher.join()
+    scheduler.join()
+
+def download_trailers(db, res):
+    ''' Build a list of movies and then call the appropriate download method
+        on each.
+    '''
+    if options.redownload:
+        #User specified a title string to download, so build our list of movies
+        #using that
+        movies = select_movies(db, title=options.redownload)
+    else:
+        #Get all movies
+        movies = select_movies(db)
 
+    #Check available resolutions for every trailer up front so the probes run
+    #concurrently instead of one at a time as each trailer is downloaded
+    trailers = []
     for movie in movies:
         if isinstance(movie, Movie):
-            print '*'*50
-            print "Checking/downloading for %s" % movie.title
-            if options.redownload:
-                ''' Since --download option was used, call Movie.download_trailers()
-                    with force=True because we don't care if we've already downloaded the trailer before
-                '''
-                movie.download_trailers(res, force=True)
-            else:
-                #Call Movie.download_trailers()
-                movie.download_trailers(res)
-            persist_movie(movie, db)
+            trailers.extend(movie.trailers.values())
+    fetch_available_res(trailers)
 
-def persist_movie(movie, db):
+    scheduler = DownloadScheduler(options.concurrent, options.per_host,
+                                  options.limit_rate * 1024,
+                                  on_complete=lambda movie: persist_movie(movie, db, commit=True))
+    for movie in movies:
+        if isinstance(movie, Movie):
+            ''' If --download option was used, force the download because we
+                don't care if we've already downloaded the trailer before
+            '''
+            scheduler.add(movie, res, force=bool(options.redownload))
+    scheduler.run()
+
+#Movies get saved from more than one thread (see ImdbEnricher), and saving
+#one means reading, syncing and replacing its row
+_persist_lock = threading.RLock()
+
+def persist_movie(movie, db, commit=False):
     ''' Surprisingly this function is used for saving a Movie object to our
-        database.
+        database.  Returns the Movie as saved, which has been synced with what
+        we already had stored.
+
+        When the database connection is being held open for the whole run,
+        "commit" commits everything written so far once the movie is saved,
+        so it isn't lost if we're killed and other processes can get at it.
+    '''
+    _persist_lock.acquire()
+    try:
+        movie = _persist_movie(movie, db)
+        if commit:
+            db.commit()
+        return movie
+    finally:
+        _persist_lock.release()
+
+def checkpoint(db, release=False):
+    ''' Commit everything written to the database so far, or with "release"
+        undo our db.hold() instead (which commits once it's the last one).
+        Waits for any movie that's in the middle of being saved so it's
+        committed whole.
     '''
+    _persist_lock.acquire()
+    try:
+        if release:
+            db.release()
+        else:
+            db.commit()
+    finally:
+        _persist_lock.release()
+
+def _persist_movie(movie, db):
     tags = movie.get_tags()
 
     #check if movie is in our database
@@ -307,14 +692,20 @@ def persist_movie(movie, db):
         print "Updating %s in database" % movie.title
 
         movie = sync_movie(persisted_movie, movie)
-        delete_by_apple_id(movie.apple_id, db)
     else:
         print "Saving %s to database" % movie.title
 
+    #The new copy goes in before the old one is deleted, so being
+    #interrupted in between leaves the movie stored twice rather than not
+    #at all.  The newest copy is the one that's used.
     try:
-        db.insert(movie, tags, 'movies')
+        db.inindexed(movie, tags, movie_columns(movie), 'movies')
     except:
         raise ValueError("DB ERROR: %s, %s" % (movie.title, tags))
+    if persisted_movie:
+        delete_older_movies(movie.apple_id, db)
+
+    return movie
 
 def update_movies(db):
     ''' This is the main function for freshening our database with current info
@@ -325,55 +716,198 @@ def update_movies(db):
 
         The only parameter is "db" which is a reference to a y_serial database.
     '''
-    movies = build_movies(db)
-    if not movies:
-        return
+    movies = build_movies(db) or []
+
+    #Ratings are looked up in the background as movies are saved, and we
+    #wait for them before going on to download anything
+    enricher = ImdbEnricher(db)
+    enricher.start()
+    saved = set()
     for movie in movies:
-        persist_movie(movie, db)
+        movie = persist_movie(movie, db)
+        saved.add(movie.apple_id)
+        enricher.add(movie)
+    checkpoint(db)
+
+    #Movies from earlier runs that never got their rating get another try,
+    #even if the feed hasn't changed since
+    for movie in pending_movies(db, skip_ids=saved):
+        enricher.add(movie)
+    enricher.join()
 
 
 def fetch_by_apple_id(apple_id, db):
     ''' Fetches the movie object for the specified apple_id from the database
     '''
     try:
-        return db.select('apple_id:%s' % apple_id, 'movies')
+        return db.omaxcol('apple_id', apple_id, 'movies')
     except:
         return
 
 def fetch_by_movie_title(title, db):
     '''Fetches movies whose title contains 'title'
     '''
-    movies = [x[2] for x in db.selectdic("title:%s" % title, 'movies').values()]
+    return load_movies(movie_rows(db, title))
 
-    return movies
+def delete_older_movies(apple_id, db):
+    ''' Deletes every stored copy of the movie with "apple_id" but the newest.
+    '''
+    db.deletesub('WHERE apple_id = ? AND kid < (SELECT MAX(kid) FROM movies WHERE apple_id = ?)',
+                 [apple_id, apple_id], 'movies')
 
 def delete_by_apple_id(apple_id, db):
-    db.delete('apple_id:%s' % apple_id, 'movies')
-    if not db.select('apple_id:%s' % apple_id, 'movies'):
+    db.deletecol('apple_id', apple_id, 'movies')
+    if not db.omaxcol('apple_id', apple_id, 'movies'):
         return True
     return False
 
-def build_movies(db=None):
+#Movie attributes that get their own indexed column in the movies table.
+#trailer_date is the date of the movie's newest trailer, and imdb_pending is
+#1 for movies still waiting on a rating from IMDb.
+MOVIE_COLUMNS = ['apple_id', 'title', 'release_date', 'xml_digest', 'trailer_date',
+                 'imdb_pending']
+
+#Dates are stored as text in these formats so SQLite can compare them
+RELEASE_DATE_FORMAT = "%Y-%m-%d"
+TRAILER_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def movie_columns(movie):
+    ''' Returns the values of the indexed movies table columns for a Movie.
+    '''
+    if movie.release_date:
+        release_date = datetime.datetime.strftime(movie.release_date, RELEASE_DATE_FORMAT)
+    else:
+        release_date = None
+    trailer_dates = [t.date for t in movie.trailers.values() if t.date]
+    if trailer_dates:
+        trailer_date = datetime.datetime.strftime(max(trailer_dates), TRAILER_DATE_FORMAT)
+    else:
+        trailer_date = None
+    return {'apple_id': movie.apple_id,
+            'title': movie.title,
+            'release_date': release_date,
+            'xml_digest': movie.xml_digest,
+            'trailer_date': trailer_date,
+            'imdb_pending': int(bool(movie.imdb_pending))}
+
+def setup_movie_store(db):
+    ''' Makes sure the movies table has its indexed columns, and fills them in
+        for any movies saved before they existed.
+    '''
+    db.addcolumns(MOVIE_COLUMNS, 'movies')
+
+    #Only movies have apple_id in their notes, which keeps out current_xml_date.
+    #trailer_date and imdb_pending are checked too since they were added after
+    #the other columns.
+    rows = db.dicsub('WHERE (apple_id IS NULL OR trailer_date IS NULL OR imdb_pending IS NULL) AND notes GLOB ?',
+                     ['*apple_id:*'], 'movies')
+    if rows:
+        print "Indexing %s movies in database" % len(rows)
+    for kid in rows:
+        if isinstance(rows[kid][2], Movie):
+            db.updatecols(kid, movie_columns(rows[kid][2]), 'movies')
+
+def build_movies(db=None, workers=None):
+    ''' Builds a Movie for every movie in Apple's xml.  Each Movie does its own
+        network lookups while being built, so we build up to "workers" of them
+        at once (defaults to --build-workers).  Movies are returned in the same
+        order as they're listed in the xml.
+    '''
     movies_xml = _fetchxml(db)
     if not movies_xml:
         return
-    movies = []
 
-    count = 0
-    for movie_xml in movies_xml:
-        print "Fetching movie info: %s/%s" % (count, len(movies_xml)) + "\r",
-        movies.append(Movie(movie_xml))
-        count += 1
+    if not workers:
+        workers = options.build_workers
+
+    #We don't know how many movies there are until the xml has been read to
+    #the end, so the total is how many we've read so far
+    progress = {'count': 0, 'total': 0}
+    def count(movies_xml):
+        for movie_xml in movies_xml:
+            progress['total'] += 1
+            yield movie_xml
+
+    def report(index, movie):
+        progress['count'] += 1
+        print "Fetching movie info: %s/%s" % (progress['count'], progress['total']) + "\r",
+
+    movies = _thread_map(lambda movie_xml: _build_movie(movie_xml, db),
+                         count(movies_xml), workers, callback=report)
     print
     return movies
 
-def db_conx(filename):
+#SQLite settings for our database.  WAL lets anything reading the database
+#carry on while a run is writing to it.
+DB_PRAGMAS = {'journal_mode': 'WAL',
+              'synchronous': 'NORMAL',
+              'cache_size': -16000,
+              'mmap_size': 64 * 1024 * 1024,
+              'temp_store': 'MEMORY'}
+
+def db_conx(filename, pragmas=None):
+    ''' Open our database.  "pragmas" is a dict of SQLite PRAGMA settings,
+        by default DB_PRAGMAS along with any --db-pragma options.
+    '''
     if not os.path.exists(filename):
         open(filename, 'w').close()
 
+    if pragmas is None:
+        pragmas = dict(DB_PRAGMAS)
+        pragmas.update(options.db_pragmas)
+
+    y_serial.setcodec(*options.db_codec)
+
     db_path = os.path.abspath(filename)
     print "Database location: %s" % db_path
-    return y_serial.Main(db_path)
+    db = y_serial.Main(db_path, pragmas)
+    setup_movie_store(db)
+    return db
+
+def benchmark_codecs(db):
+    ''' Prints how fast, and how small, each of the database codecs saves and
+        loads the movies in the database.
+    '''
+    movies = get_movies_from_db(db)
+    if not movies:
+        print "No movies in the database to benchmark with.  Run without --benchmark first."
+        return
+
+    print "Saving and loading %s movies with each codec..." % len(movies)
+    print "%-8s %5s %8s %12s %12s %12s" % ('codec', 'level', 'protocol', 'bytes', 'save MB/s', 'load MB/s')
+    for name, level, protocol, size, dumps, loads in y_serial.benchcodecs(movies):
+        print "%-8s %5s %8s %12s %12.1f %12.1f" % (name, level or '-', protocol, size, dumps, loads)
+
+def benchmark_hash(db, rounds=20):
+    ''' Prints how long hash_file() and _hash_file_reference() take on the
+        trailers we've downloaded, making sure they agree.
+    '''
+    paths = set()
+    for movie in get_movies_from_db(db):
+        for trailer in movie.trailers.values():
+            for url in trailer.urls.values():
+                if url.downloaded and url.local_path and os.path.isfile(url.local_path):
+                    paths.add(url.local_path)
+    if not paths:
+        print "No downloaded trailers to benchmark with.  Run without --benchmark first."
+        return
+
+    print "Hashing %s trailers %s times each..." % (len(paths), rounds)
+    timings = {}
+    for func in (_hash_file_reference, hash_file):
+        start = time.time()
+        for x in range(rounds):
+            for path in paths:
+                func(path)
+        timings[func] = time.time() - start
+
+    for path in paths:
+        if hash_file(path) != _hash_file_reference(path):
+            print "MISMATCH: %s" % path
+
+    print "reference: %.4fs  hash_file: %.4fs  speedup: %.1fx" % (timings[_hash_file_reference],
+                                                                timings[hash_file],
+                                                                timings[_hash_file_reference] / max(timings[hash_file], 1e-9))
 
 def mkdir(d):
     ''' Tries to make a directory and avoid race conditions.
@@ -390,6 +924,37 @@ def mkdir(d):
 
 def hash_file(path):
     ''' Generates a hopefully unique hash of a trailer.
+
+        The hash is the file size plus the sum of the first and last 64KB of
+        the file taken as 64-bit integers, wrapping around at 64 bits.  Each
+        64KB block is read and unpacked in one go.  _hash_file_reference()
+        is the same hash done 8 bytes at a time, and gives identical results.
+    '''
+    block = 65536
+    #native byte order, as the hashes we've already stored were made with
+    blockformat = '%sq' % (block / struct.calcsize('q'))
+
+    try:
+        f = open(path, "rb")
+        try:
+            filesize = os.path.getsize(path)
+            if filesize < block * 2:
+                return "SizeError"
+
+            hash = filesize
+            hash += sum(struct.unpack(blockformat, f.read(block)))
+            f.seek(max(0, filesize - block), 0)
+            hash += sum(struct.unpack(blockformat, f.read(block)))
+        finally:
+            f.close()
+        return "%016x" % (hash & 0xFFFFFFFFFFFFFFFF) #to remain as 64bit number
+
+    except(IOError):
+        return "IOError"
+
+def _hash_file_reference(path):
+    ''' The original hash_file(), which reads 8 bytes at a time.  Kept to check
+        hash_file() against and to benchmark it with.
     '''
     try:
         longlongformat = 'q'  # long long
@@ -424,34 +989,818 @@ def hash_file(path):
     except(IOError):
         return "IOError"
 
-def _get_trailer_opener(url):
-    ''' Returns an urllib2 opener with the user agent set to the current version
-        of QuickTime.
+class ContentIndex():
+    ''' Remembers the hash_file() hash, size and modification time of every
+        trailer we've saved, in its own table so --flush doesn't forget it.
+
+        This lets move_file() spot a file we already have, whatever it's
+        called, with one lookup instead of hashing files on disk.  An entry
+        only counts while the file is still there with the same size and
+        modification time, and stale entries are dropped as they're found.
+    '''
+    table = 'content'
+    columns = ['hash', 'path', 'size', 'mtime']
+
+    def __init__(self, db):
+        self.db = db
+        self.db.addcolumns(self.columns, self.table)
+
+    @staticmethod
+    def usable(digest):
+        ''' hash_file() returns an error string for files it can't hash.
+        '''
+        return digest not in (None, 'SizeError', 'IOError')
+
+    def _rows(self, column, value):
+        return self.db.rowsub('WHERE %s = ? ORDER BY kid DESC' % column, [value],
+                              self.columns, self.table)
+
+    def _current(self, row):
+        try:
+            stat = os.stat(row.path)
+        except OSError:
+            return False
+        return stat.st_size == row.size and stat.st_mtime == row.mtime
+
+    def add(self, path, digest):
+        ''' Record that the file at "path" has the hash "digest".
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.remove(path)
+        self.db.inindexed(path, "#'path:%s'" % path,
+                          {'hash': digest, 'path': path,
+                           'size': stat.st_size, 'mtime': stat.st_mtime},
+                          self.table)
+        checkpoint(self.db)
+
+    def remove(self, path):
+        self.db.deletecol('path', os.path.abspath(path), self.table)
+
+    def lookup(self, digest):
+        ''' Returns the path of a file we have with hash "digest", or None.
+        '''
+        for row in self._rows('hash', digest):
+            if self._current(row):
+                return row.path
+            self.remove(row.path)
+        return None
+
+    def hash_of(self, path):
+        ''' Returns the hash we recorded for the file at "path", or None if we
+            don't know it or the file has changed since.
+        '''
+        for row in self._rows('path', os.path.abspath(path)):
+            if self._current(row):
+                return row.hash
+            self.remove(row.path)
+        return None
+
+class ImdbCache():
+    ''' Remembers the MPAA ratings we've looked up on IMDb, by title and year,
+        in their own table so --flush doesn't forget them.  Movies Apple lists
+        as "Not Yet Rated" tend to stay that way for months, and this saves
+        us asking IMDb about each of them on every run.
+
+        Ratings found are trusted for --imdb-ttl days.  When IMDb had nothing
+        for us that's remembered too, but only for --imdb-miss-ttl days.
+    '''
+    table = 'imdb_cache'
+    columns = ['imdb_key', 'rating', 'checked']
+
+    def __init__(self, db, ttl=None, miss_ttl=None):
+        self.db = db
+        if ttl is None:
+            ttl = options.imdb_ttl
+        if miss_ttl is None:
+            miss_ttl = options.imdb_miss_ttl
+        self.ttl = ttl * 86400
+        self.miss_ttl = miss_ttl * 86400
+        self.db.addcolumns(self.columns, self.table)
+
+    def _key(self, title, year):
+        return "%s|%s" % (' '.join(title.lower().split()), year)
+
+    def get(self, title, year):
+        ''' Returns (True, rating) if we have a recent enough answer for this
+            movie, rating being None if IMDb didn't have one, or (False, None)
+            if we need to ask IMDb.
+        '''
+        rows = self.db.rowsub('WHERE imdb_key = ? ORDER BY kid DESC LIMIT 1',
+                              [self._key(title, year)], self.columns, self.table)
+        if not rows:
+            return (False, None)
+        row = rows[0]
+        if row.rating:
+            ttl = self.ttl
+        else:
+            ttl = self.miss_ttl
+        if time.time() - row.checked >= ttl:
+            return (False, None)
+        return (True, row.rating)
+
+    def store(self, title, year, rating):
+        key = self._key(title, year)
+        self.db.deletecol('imdb_key', key, self.table)
+        self.db.inindexed(rating, "#'imdb:%s'" % key,
+                          {'imdb_key': key, 'rating': rating, 'checked': time.time()},
+                          self.table)
+
+class ImdbEnricher():
+    ''' Looks up ratings on IMDb for movies Apple lists as not yet rated, on
+        a pool of "workers" threads (defaults to --imdb-workers), and saves
+        each movie again once it has its rating.
+
+        A lookup that can't reach IMDb is retried "attempts" times, waiting
+        "backoff" seconds before the first retry and twice as long before
+        each one after.  If it never gets through the movie is left pending
+        and is looked up again on the next run.
+    '''
+    attempts = 3
+    backoff = 1
+
+    def __init__(self, db, workers=None):
+        self.db = db
+        if not workers:
+            workers = options.imdb_workers
+        self.pool = WorkerPool(self._work, workers)
+
+    def add(self, movie, callback=None):
+        ''' Queue "movie" to have its rating looked up, if it needs it.
+            "callback" is called with the movie once that's done (or right
+            away if there's nothing to do).
+        '''
+        if not movie.imdb_pending:
+            if callback:
+                callback(movie)
+            return
+        self.pool.put((movie, callback))
+
+    def start(self):
+        self.pool.start()
+
+    def join(self):
+        ''' Wait for every movie queued so far, then stop the workers.
+        '''
+        self.pool.join()
+
+    def _work(self, job):
+        movie, callback = job
+        if self._enrich(movie):
+            persist_movie(movie, self.db, commit=True)
+        if callback:
+            callback(movie)
+
+    def _enrich(self, movie):
+        delay = self.backoff
+        for attempt in range(self.attempts):
+            try:
+                movie._getimdb()
+                return True
+            except IOError, e:
+                if attempt + 1 < self.attempts:
+                    time.sleep(delay)
+                    delay = delay * 2
+            except Exception, e:
+                break
+        print "Couldn't get a rating for %s: %s" % (movie.title, e)
+        return False
+
+class ProbeCache():
+    ''' Remembers what we got back when we checked whether a trailer url
+        exists (its HTTP status and content type), in its own table so
+        --flush doesn't forget it.  probe_urls() uses this so looking for
+        other trailers of a movie and checking which resolutions a trailer
+        comes in don't ask Apple the same thing on every run.
+
+        Urls that turned out to be trailers are trusted for --probe-ttl days,
+        and those that didn't for --probe-miss-ttl days.  Urls we couldn't
+        get any answer for aren't remembered.
+    '''
+    table = 'probe_cache'
+    columns = ['url', 'status', 'content_type', 'checked']
+
+    #SQLite only allows so many parameters in one query
+    batch = 500
+
+    def __init__(self, db, ttl=None, miss_ttl=None):
+        self.db = db
+        if ttl is None:
+            ttl = options.probe_ttl
+        if miss_ttl is None:
+            miss_ttl = options.probe_miss_ttl
+        self.ttl = ttl * 86400
+        self.miss_ttl = miss_ttl * 86400
+        self.db.addcolumns(self.columns, self.table)
+
+    def lookup(self, urls):
+        ''' Returns a dict mapping each of "urls" we have a recent enough
+            answer for to its (status, content type).
+        '''
+        now = time.time()
+        results = {}
+        for i in range(0, len(urls), self.batch):
+            chunk = urls[i:i + self.batch]
+            subquery = 'WHERE url IN (%s) ORDER BY kid' % ', '.join(['?'] * len(chunk))
+            for row in self.db.rowsub(subquery, chunk, self.columns, self.table):
+                if _is_quicktime(row.status, row.content_type):
+                    ttl = self.ttl
+                else:
+                    ttl = self.miss_ttl
+                if now - row.checked < ttl:
+                    results[row.url] = (row.status, row.content_type)
+                else:
+                    results.pop(row.url, None)
+        return results
+
+    def store(self, results):
+        ''' Remember a dict mapping urls to (status, content type).
+        '''
+        now = time.time()
+        for url in results:
+            status, content_type = results[url]
+            if status is None:
+                continue
+            self.db.deletecol('url', url, self.table)
+            self.db.inindexed(results[url], "#'probe:%s'" % url,
+                              {'url': url, 'status': status,
+                               'content_type': content_type, 'checked': now},
+                              self.table)
+        checkpoint(self.db)
+
+class HTTPConnectionPool():
+    ''' Keeps HTTP/1.1 connections open between requests so the thousands of
+        small requests we make to Apple (mostly checking whether trailers
+        exist) don't each pay for a new TCP connection.
+
+        A connection goes back in the pool once the response on it has been
+        read to the end.  Connections that sit idle longer than
+        "idle_timeout" seconds are closed rather than reused, since the
+        server has probably given up on them by then, and we keep at most
+        "max_idle" idle connections per server.
+
+        Errors are raised as urllib2.HTTPError so callers can treat this like
+        urllib2.urlopen().  Like urllib2, requests go through the proxy set in
+        the http_proxy/https_proxy environment variables (https by tunnelling
+        through it) unless no_proxy says otherwise.
+    '''
+    def __init__(self, max_idle=8, idle_timeout=15, timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'reused': 0, 'new': 0, 'evicted': 0}
+
+    def stats(self):
+        ''' Returns a dict of how many requests we've made, how many of
+            them reused a connection, how many connections were opened, and
+            how many idle connections were thrown away.
+        '''
+        self.lock.acquire()
+        try:
+            return dict(self.counts)
+        finally:
+            self.lock.release()
+
+    def urlopen(self, url, method='GET', headers=None, redirects=5):
+        ''' Make a request and return a file-like response with the same
+            info(), getcode(), geturl(), read() and close() as urllib2's.
+            Redirects are followed up to "redirects" times.
+        '''
+        if not headers:
+            headers = {}
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
+        proxy = self._proxy(scheme, netloc)
+        key = (scheme, netloc, proxy)
+        if proxy and scheme == 'http':
+            #a proxy needs the whole url, not just the path
+            path = urlparse.urlunparse((scheme, netloc, path or '/', params, query, ''))
+            if proxy[1]:
+                headers = dict(headers)
+                headers['Proxy-Authorization'] = proxy[1]
+        else:
+            path = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+
+        conn, reused = self._checkout(key)
+        try:
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                #The server closed this one on us while it was idle, so
+                #try again on a fresh connection
+                conn, reused = self._checkout(key, fresh=True)
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+        pooled = _PooledResponse(self, key, conn, response, url, method)
+
+        if response.status in (301, 302, 303, 307) and redirects:
+            location = response.getheader('Location')
+            pooled.read()
+            if location:
+                if response.status == 303:
+                    method = 'GET'
+                return self.urlopen(urlparse.urljoin(url, location), method, headers, redirects - 1)
+
+        if response.status >= 400:
+            body = pooled.read()
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, cStringIO.StringIO(body))
+
+        return pooled
+
+    def _proxy(self, scheme, netloc):
+        ''' Returns the host:port of the proxy to use for a server, and the
+            Proxy-Authorization header to send it (or None), or None if we
+            should connect straight to the server.
+        '''
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(netloc.split(':')[0]):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlparse.urlparse(proxy)
+        auth = None
+        if parts.username:
+            creds = '%s:%s' % (urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+            auth = 'Basic ' + base64.b64encode(creds)
+        return parts.netloc.split('@')[-1], auth
+
+    def _checkout(self, key, fresh=False):
+        ''' Get an idle connection to the server in "key" or make a new one.
+            Returns the connection and whether it was reused.  "fresh" is for
+            retrying a request on a new connection, so it isn't counted as
+            another request.
+        '''
+        self.lock.acquire()
+        try:
+            if not fresh:
+                self.counts['requests'] += 1
+            idle = self.idle.get(key, [])
+            while idle and not fresh:
+                conn, stamp = idle.pop()
+                if time.time() - stamp > self.idle_timeout:
+                    conn.close()
+                    self.counts['evicted'] += 1
+                    continue
+                self.counts['reused'] += 1
+                return conn, True
+            self.counts['new'] += 1
+        finally:
+            self.lock.release()
+
+        scheme, netloc, proxy = key
+        if proxy:
+            proxy_host, auth = proxy
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(proxy_host, timeout=self.timeout)
+                tunnel_headers = {}
+                if auth:
+                    tunnel_headers['Proxy-Authorization'] = auth
+                conn.set_tunnel(netloc, headers=tunnel_headers)
+                return conn, False
+            return httplib.HTTPConnection(proxy_host, timeout=self.timeout), False
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _checkin(self, key, conn):
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) >= self.max_idle:
+                conn.close()
+                self.counts['evicted'] += 1
+            else:
+                idle.append((conn, time.time()))
+        finally:
+            self.lock.release()
+
+class _PooledResponse():
+    ''' Response from HTTPConnectionPool.urlopen().  Hands its connection
+        back to the pool once the body has been read to the end.
+    '''
+    def __init__(self, pool, key, conn, response, url, method):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+        if method == 'HEAD' or response.status in (204, 304):
+            #no body coming, so we can let the connection go right away
+            self.read()
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        if not self.conn:
+            return ''
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool._checkin(self.key, self.conn)
+        self.conn = None
+
+    def close(self):
+        if self.conn:
+            #There's unread data on the connection so it can't be reused
+            self.conn.close()
+            self.conn = None
+
+http_pool = HTTPConnectionPool()
+
+#The ContentIndex for our database, set up when we're run as a script.
+#Without one move_file() hashes files to compare them.
+content_index = None
+
+#The ImdbCache for our database, set up when we're run as a script.
+#Without one every unrated Movie is looked up on IMDb.
+imdb_cache = None
+
+#The ProbeCache for our database, set up when we're run as a script.
+#Without one probe_urls() always asks Apple.
+probe_cache = None
+
+#The IMDb access object every lookup shares, see imdb_client()
+_imdb_client = None
+_imdb_lock = threading.Lock()
+
+def imdb_client():
+    ''' Returns the IMDb access object shared by all our lookups.  imdb is
+        only imported, and the object made, when the first movie needs a
+        rating, so runs that don't look anything up never pay for it.
+    '''
+    global _imdb_client
+    _imdb_lock.acquire()
+    try:
+        if _imdb_client is None:
+            import imdb
+            _imdb_client = imdb.IMDb()
+        return _imdb_client
+    finally:
+        _imdb_lock.release()
+
+def _get_trailer_opener(url, method='GET', headers=None):
+    ''' Returns an opened url from our shared connection pool with the user
+        agent set to the current version of QuickTime.  Use method='HEAD' when
+        only the headers are needed.  Any extra request headers can be passed
+        in the "headers" dict.
     '''
     user_agent = r"QuickTime/%s" % _get_QT_version('English', 'Windows')
 
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', user_agent)
-    opener = urllib2.urlopen(request)
-    return opener
+    request_headers = {'User-Agent': user_agent}
+    if headers:
+        request_headers.update(headers)
+    return http_pool.urlopen(url, method, request_headers)
+
+def _copy_stream(source, dest, bufsize, throttle=None, cancel=None):
+    ''' Copies the file-like object "source" to "dest" in chunks of "bufsize"
+        bytes so we never hold more than one chunk in memory.  Returns the
+        number of bytes copied.
+
+        If a TokenBucket is passed as "throttle", every chunk read is counted
+        against it.  If a threading.Event is passed as "cancel", copying
+        stops early once it's set.
+    '''
+    copied = 0
+    while 1:
+        if cancel and cancel.isSet():
+            break
+        chunk = source.read(bufsize)
+        if not chunk:
+            break
+        if throttle:
+            throttle.consume(len(chunk))
+        dest.write(chunk)
+        copied += len(chunk)
+    return copied
+
+def _is_quicktime(status, content_type):
+    ''' Checks the result of a _probe_url() to see if there's a quicktime
+        video at the url.
+    '''
+    return status is not None and status < 400 and content_type == 'video/quicktime'
+
+def wait_threads(threads):
+    ''' Wait for every thread in "threads" to finish.
+    '''
+    for t in threads:
+        #a timeout keeps the wait interruptable by ctrl-c
+        while t.isAlive():
+            t.join(1)
+
+class WorkerPool():
+    ''' Calls "handler" with each job put() on the pool, from a pool of
+        "workers" threads.  If "maxsize" is set, put() blocks while that many
+        jobs are already waiting.  Exceptions raised by handler are printed
+        and the worker goes on to the next job.
+    '''
+    def __init__(self, handler, workers, maxsize=0):
+        self.handler = handler
+        self.workers = workers
+        self.jobs = Queue.Queue(maxsize)
+        self.threads = []
+
+    def start(self):
+        for x in range(self.workers):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def put(self, job, block=True, timeout=None):
+        self.jobs.put(job, block, timeout)
+
+    def join(self):
+        ''' Wait for every job put so far to be handled, then stop the
+            workers.
+        '''
+        for t in self.threads:
+            self.jobs.put(None)
+        wait_threads(self.threads)
+        self.threads = []
+
+    def stop(self):
+        ''' Drop the jobs nobody has started on, then wait for the rest and
+            stop the workers.
+        '''
+        while 1:
+            try:
+                self.jobs.get_nowait()
+            except Queue.Empty:
+                break
+        self.join()
+
+    def _work(self):
+        while 1:
+            job = self.jobs.get()
+            if job is None:
+                #sentinel...no more work
+                return
+            try:
+                self.handler(job)
+            except Exception, e:
+                print "Error processing %s: %s" % (job, e)
+
+def _thread_map(func, items, workers, callback=None):
+    ''' Calls func on every item in items using a pool of "workers" threads and
+        returns a list of the results in the same order as items.
+
+        items can be any iterable and is consumed lazily, so a generator is
+        never read much further ahead than the workers can keep up with.  If
+        "callback" is given it's called from the calling thread as
+        callback(index, result) whenever a result comes in.
+
+        If func raises, the exception is re-raised in the calling thread once
+        the workers have finished whatever they were in the middle of.  Items
+        not started yet are dropped.
+    '''
+    done = Queue.Queue()
+    results = {}
+
+    def work(job):
+        index, item = job
+        try:
+            done.put((index, func(item), None))
+        except:
+            done.put((index, None, sys.exc_info()))
+
+    pool = WorkerPool(work, workers, workers * 2)
+    pool.start()
+
+    def collect(block):
+        while 1:
+            try:
+                #a timeout keeps the wait interruptable by ctrl-c
+                index, result, exc = done.get(block, 86400)
+            except Queue.Empty:
+                return
+            if exc:
+                pool.stop()
+                raise exc[0], exc[1], exc[2]
+            results[index] = result
+            if callback:
+                callback(index, result)
+            if block:
+                return
+
+    count = 0
+    for item in items:
+        while 1:
+            try:
+                pool.put((count, item), True, 0.1)
+                break
+            except Queue.Full:
+                collect(False)
+        count += 1
+        collect(False)
+
+    while len(results) < count:
+        collect(True)
+    pool.join()
+
+    return [results[i] for i in range(count)]
+
+def _probe_url(url):
+    ''' Sends a HEAD request for url and returns the HTTP status and content
+        type of the answer, or (None, None) if we didn't get one.
+    '''
+    try:
+        opener = _get_trailer_opener(url, method='HEAD')
+    except urllib2.HTTPError, e:
+        return (e.code, None)
+    except:
+        print "Unknown error with trailer probe (http): %s" % url
+        return (None, None)
+
+    result = (opener.getcode(), opener.info().gettype())
+    opener.close()
+    return result
+
+def probe_urls(urls, workers=None):
+    ''' Checks all of urls concurrently and returns a dict mapping each url to
+        True if it's an existing quicktime video, False otherwise.
+
+        Urls with a recent enough answer in our probe_cache aren't asked about
+        again, and the answers we do get are added to it.
+    '''
+    if not workers:
+        workers = options.probe_workers
+
+    unique_urls = []
+    seen = set()
+    for url in urls:
+        if url not in seen:
+            seen.add(url)
+            unique_urls.append(url)
+
+    if not unique_urls:
+        return {}
+
+    if probe_cache:
+        results = probe_cache.lookup(unique_urls)
+    else:
+        results = {}
+
+    unchecked = [url for url in unique_urls if url not in results]
+    if unchecked:
+        checked = dict(zip(unchecked, _thread_map(_probe_url, unchecked,
+                                                  min(workers, len(unchecked)))))
+        if probe_cache:
+            probe_cache.store(checked)
+        results.update(checked)
+
+    return dict((url, _is_quicktime(*results[url])) for url in unique_urls)
+
+def fetch_available_res(trailers, workers=None):
+    ''' The probing engine behind Trailer.available_res.  Checks every
+        potential resolution of every trailer in "trailers" that's due for a
+        check, with all the requests for all the trailers sharing one pool
+        of "workers" connections.
+
+        Fills in Trailer.urls for each trailer checked and returns a dict
+        mapping each checked trailer to its list of available resolutions.
+    '''
+    stale = [t for t in trailers if t.res_stale()]
+
+    urls = []
+    for trailer in stale:
+        for res in trailer.potential_res:
+            url = trailer.res_url(res)
+            if url:
+                urls.append(url)
+
+    found = probe_urls(urls, workers)
+
+    available = {}
+    for trailer in stale:
+        rezs = [res for res in trailer.potential_res if found.get(trailer.res_url(res))]
+        available[trailer] = trailer.set_available_res(rezs)
+
+    return available
 
 def _get_QT_version(lang, os):
     return '7.0.0'
 
+CURRENT_XML_URL = r"http://www.apple.com/trailers/home/xml/current.xml"
+
+class FeedCache():
+    ''' Keeps the last copy of current.xml we downloaded, gzipped, next to
+        our database, along with the ETag and Last-Modified headers it came
+        with so we can ask Apple to only send it again if it has changed.
+
+        The headers are stored in their own table so --flush doesn't forget
+        them.
+    '''
+    table = 'feed_cache'
+
+    def __init__(self, db):
+        self.db = db
+        self.path = os.path.splitext(db.db)[0] + '-current.xml.gz'
+
+    def has_body(self):
+        return os.path.isfile(self.path)
+
+    def open(self):
+        return gzip.open(self.path, 'rb')
+
+    def conditional_headers(self):
+        ''' Headers that make the server answer 304 if our copy is current.
+        '''
+        headers = {}
+        if not self.has_body():
+            return headers
+        try:
+            validators = self.db.select('validators', self.table)
+        except:
+            validators = None
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def store(self, response):
+        ''' Save the body of "response" to disk and remember its validators.
+        '''
+        tmp_path = self.path + '.tmp'
+        f = gzip.open(tmp_path, 'wb')
+        try:
+            _copy_stream(response, f, 64 * 1024)
+        finally:
+            f.close()
+            response.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+        info = response.info()
+        validators = {'etag': info.getheader('ETag'),
+                      'last_modified': info.getheader('Last-Modified')}
+        try:
+            self.db.delete('validators', self.table)
+        except:
+            pass
+        self.db.insert(validators, 'validators', self.table)
+
 def _fetchxml(db=None):
     ''' Get the xml file from apple describing all their current trailers.
-        We then parse out the ElementTree elements for each Movie and return
-        a them in a list.
+        We then return an iterator over the ElementTree elements for each
+        Movie.  The xml is parsed as the iterator is read, and each element
+        is dropped from the tree once it's been handed out, so the whole
+        document is never held in memory.
 
         If we receive a reference to our db, we check to see if the date in
-        current.xml has changed...if not we return None.
+        current.xml has changed...if not we return None.  With a db we also
+        keep a copy of current.xml (see FeedCache) and only download it again
+        when Apple says it has changed.  On --flush runs the copy is used
+        without checking with Apple at all.
     '''
-    current_trailers = r"http://www.apple.com/trailers/home/xml/current.xml"
-    response = urllib2.urlopen(current_trailers)
-    tree = ElementTree(file=response)
+    if db:
+        cache = FeedCache(db)
+        if options.flush and cache.has_body():
+            print "Using saved copy of Apple trailers information"
+            source = cache.open()
+        else:
+            response = http_pool.urlopen(CURRENT_XML_URL, headers=cache.conditional_headers())
+            #On a 304 nothing has changed since we last downloaded it.  We
+            #still check its date below in case our stored date was lost.
+            if response.getcode() != 304:
+                cache.store(response)
+            source = cache.open()
+    else:
+        source = http_pool.urlopen(CURRENT_XML_URL)
+
+    #The date is on the root element, so we have it as soon as parsing starts
+    events = iterparse(source, events=('start', 'end'))
+    event, root = events.next()
+
     if db:
         #date checking
-        date = tree.getroot().attrib['date']
+        date = root.attrib['date']
         d = rfc822.parsedate(date)
         date = datetime.datetime(d[0], d[1], d[2], d[3], d[4])
 
@@ -463,6 +1812,7 @@ def _fetchxml(db=None):
             stored_date = datetime.datetime(year=2000, month = 1, day = 1)
         if date <= stored_date:
             print "Already have current Apple trailers information"
+            source.close()
             return
         else:
             try:
@@ -471,15 +1821,268 @@ def _fetchxml(db=None):
                 pass
             db.insert(date, 'current_xml_date', 'movies')
     #information for each trailer is stored in it's own 'movieinfo' node
-    #here we create list of Elements with each Element containing the tree for
+    #here we hand out Elements with each Element containing the tree for
     #one movie/trailer
-    movies = tree.findall('movieinfo')
+    movies = _iter_movieinfo(source, events, root)
+    if db and options.incremental:
+        movies = _changed_movieinfo(movies, stored_digests(db))
     return movies
 
-class Movie():
-    def __init__(self, xml):
-        ''' Takes a movieinfo node from Apple's trailer xml file.
+def movieinfo_digest(movie_xml):
+    ''' Returns a hash of the contents of a movieinfo element.  Whitespace
+        around text and the order of attributes don't count, so the hash only
+        changes when the information itself does.
+    '''
+    digest = hashlib.sha1()
+    for elem in movie_xml.iter():
+        digest.update(repr((elem.tag, sorted(elem.attrib.items()), (elem.text or '').strip())))
+    return digest.hexdigest()
+
+def stored_digests(db):
+    ''' Returns a dict mapping apple_id to the movieinfo_digest() of every
+        movie in our database.
+    '''
+    return dict((row.apple_id, row.xml_digest) for row in movie_rows(db))
+
+def _changed_movieinfo(movies_xml, digests):
+    ''' Passes along only the movieinfo elements that are new or that have
+        changed since they were stored, according to "digests".
+    '''
+    skipped = 0
+    for movie_xml in movies_xml:
+        if digests.get(movie_xml.attrib['id']) == movieinfo_digest(movie_xml):
+            movie_xml.clear()
+            skipped += 1
+            continue
+        yield movie_xml
+    print "Skipped %s unchanged movies" % skipped
+
+def _iter_movieinfo(source, events, root):
+    ''' Yields each 'movieinfo' element from an iterparse() of current.xml
+        as soon as it has been parsed.
+    '''
+    try:
+        for event, elem in events:
+            if event == 'end' and elem.tag == 'movieinfo':
+                yield elem
+                #Forget about the elements we've handed out.  Whoever we
+                #handed elem to still has it until they're done with it.
+                root.clear()
+    finally:
+        source.close()
+
+def _build_movie(movie_xml, db=None):
+    ''' Build a Movie from its movieinfo element, then throw away the
+        element's contents since we're done with them.  With a db, trailers
+        we already have stored for the movie aren't looked for again.
+    '''
+    known_urls = ()
+    if db:
+        stored = fetch_by_apple_id(movie_xml.attrib['id'], db)
+        if isinstance(stored, Movie):
+            known_urls = stored.trailers.keys()
+    movie = Movie(movie_xml, known_urls)
+    movie_xml.clear()
+    return movie
+
+class TokenBucket():
+    ''' Bandwidth limiter shared by any number of threads.  Tokens (bytes)
+        trickle in at "rate" per second up to "burst", and consume() blocks
+        until the bytes asked for have been paid for.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if not burst:
+            burst = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            #Going into debt lets chunks bigger than the burst size through,
+            #the caller just has to wait a bit longer to pay it back
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+class DownloadScheduler():
+    ''' Runs trailer downloads for any number of movies on a pool of
+        "workers" threads.
+
+        No more than "per_host" downloads run against the same server at
+        once, and if "rate" (bytes per second) is set, all downloads share a
+        TokenBucket limiting their combined speed.  Each connection of a
+        segmented download (--segments) takes its own per_host slot, so a
+        download gets only as many segments as there are free slots.
+
+        Once every download queued for a movie has finished, on_complete is
+        called with the movie.  Moving trailers into place and on_complete
+        are serialized so they don't have to be thread safe.
+    '''
+    def __init__(self, workers, per_host, rate=0, on_complete=None):
+        self.per_host = per_host
+        if rate:
+            self.throttle = TokenBucket(rate)
+        else:
+            self.throttle = None
+        self.on_complete = on_complete
+
+        self.pool = WorkerPool(self._work, workers)
+        self.pending = {}
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.finish_lock = threading.Lock()
+
+    def add(self, movie, res, force=False, saved=False):
+        ''' Queue the "res" version of every trailer of "movie" that we don't
+            already have.  Can be called before or after start().
+
+            If "saved" is set the movie has just been saved, so on_complete
+            isn't called for it when there's nothing to download.
+        '''
+        keys = []
+        for t in movie.trailers:
+            trailer = movie.trailers[t]
+            if not force and res in trailer.urls and trailer.urls[res].downloaded:
+                continue
+            keys.append(t)
+
+        if not keys:
+            if not saved:
+                self._complete(movie)
+            return
+
+        self.lock.acquire()
+        try:
+            self.pending[movie] = self.pending.get(movie, 0) + len(keys)
+        finally:
+            self.lock.release()
+        for t in keys:
+            self.pool.put((movie, t, res, force))
+
+    def start(self):
+        self.pool.start()
+
+    def join(self):
+        ''' Wait for everything queued so far to download, then stop the
+            workers.
         '''
+        self.pool.join()
+
+    def run(self):
+        ''' Download everything that's been queued and return when done.
+        '''
+        self.start()
+        self.join()
+
+    def _host_slot(self, url):
+        host = urlparse.urlparse(url)[1]
+        self.lock.acquire()
+        try:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+        finally:
+            self.lock.release()
+
+    def _work(self, job):
+        movie, t, res, force = job
+        slot = self._host_slot(movie.trailers[t].url)
+        slot.acquire()
+        slots = 1
+        while slots < options.segments and slot.acquire(False):
+            slots += 1
+        try:
+            print "Checking/downloading %s for %s" % (os.path.basename(movie.trailers[t].url), movie.title)
+            try:
+                downloaded = movie.trailers[t].download(res, force=force, throttle=self.throttle, segments=slots)
+            except Exception, e:
+                print "Failed to download %s: %s" % (movie.trailers[t].url, e)
+                downloaded = False
+        finally:
+            for i in range(slots):
+                slot.release()
+
+        try:
+            self.finish_lock.acquire()
+            try:
+                if downloaded:
+                    movie.finish_download(t, res)
+            except Exception, e:
+                print "Failed to finish %s: %s" % (movie.trailers[t].url, e)
+            finally:
+                self.finish_lock.release()
+        finally:
+            self.lock.acquire()
+            try:
+                self.pending[movie] -= 1
+                done = not self.pending[movie]
+                if done:
+                    del self.pending[movie]
+            finally:
+                self.lock.release()
+            if done:
+                self._complete(movie)
+
+    def _complete(self, movie):
+        if self.on_complete:
+            self.finish_lock.acquire()
+            try:
+                self.on_complete(movie)
+            finally:
+                self.finish_lock.release()
+
+#Every resolution Apple might have a trailer in, best first.  Shared by all
+#Trailers rather than each keeping its own list.
+POTENTIAL_RES = ('1080p', '720p', '480p', '640w', '480', '320')
+
+class _Slotted(object):
+    ''' Base for the classes we keep thousands of in memory and pickle into
+        the database.  Subclasses list their attributes in __slots__, so
+        they don't each carry a __dict__, and give defaults in _defaults for
+        attributes older pickles might not have.
+    '''
+    __slots__ = ()
+    _defaults = {}
+
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        ''' Also restores objects pickled back when these were old-style
+            classes, whose state is their __dict__.  Unpickling those calls
+            the class with no arguments first, so subclasses' __init__ must
+            allow that.
+        '''
+        for name in self.__slots__:
+            setattr(self, name, state.get(name, self._defaults.get(name)))
+
+class Movie(_Slotted):
+    __slots__ = ('xml_digest', 'apple_id', 'title', 'runtime', 'mpaa',
+                 'release_date', 'description', 'apple_genre', 'poster_url',
+                 'large_poster_url', 'studio', 'director', 'cast', 'trailers',
+                 'inst_on', 'updated_on', 'imdb_pending')
+    _defaults = {'imdb_pending': False}
+
+    def __init__(self, xml=None, known_urls=()):
+        ''' Takes a movieinfo node from Apple's trailer xml file.  Trailer urls
+            in "known_urls" (ones we already have stored for this movie)
+            aren't checked for when looking for other trailers.
+        '''
+        self.xml_digest = None
         self.apple_id = None
         self.title = None
         self.runtime = None
@@ -497,52 +2100,70 @@ class Movie():
         self.trailers = {}
         self.inst_on = datetime.datetime.today()
         self.updated_on = datetime.datetime.today()
-        self._parsexml(xml)
-        self._getimdb()
+        self.imdb_pending = False
+        if xml is None:
+            return
+        self.xml_digest = movieinfo_digest(xml)
+        self._parsexml(xml, known_urls)
+
+        if self.mpaa and self.mpaa.lower() == 'not yet rated':
+            #An ImdbEnricher looks this up later so building Movies never
+            #waits on IMDb
+            self.mpaa = None
+            self.imdb_pending = True
 
     def download_trailers(self, res, force = False):
         for t in self.trailers:
             download = self.trailers[t].download(res, force=force)
             if not download:
                 return
-            fn = os.path.splitext(os.path.basename(self.trailers[t].urls[res].local_path))[0]
-            ext = os.path.splitext(os.path.basename(self.trailers[t].urls[res].local_path))[1][1:]
-            if self.mpaa:
-                rating = self.mpaa
-            else:
-                rating = 'NR'
-            tags = {'%TITLE%': self.title,
-                    '%FN%': fn,
-                    '%EXT%': ext,
-                    '%DT%': datetime.datetime.strftime(self.trailers[t].date, '%Y-%m%d'),
-                    '%DTD%': datetime.datetime.strftime(self.trailers[t].urls[res].downloaded, '%Y-%m%d'),
-                    '%RES%': res,
-                    '%MPAA%': rating
-                    }
-            new_fn = options.rename_mask
-
-            for tag in tags:
-                while 1:
-                    _ = new_fn
-                    new_fn = re.sub(tag, tags[tag], new_fn)
-
-                    if _ == new_fn:
-                        #nothing left to change for this tag
-                        break
+            self.finish_download(t, res)
+
+    def finish_download(self, t, res):
+        ''' Rename and move a freshly downloaded trailer according to the
+            rename mask.
+        '''
+        fn = os.path.splitext(os.path.basename(self.trailers[t].urls[res].local_path))[0]
+        ext = os.path.splitext(os.path.basename(self.trailers[t].urls[res].local_path))[1][1:]
+        if self.mpaa:
+            rating = self.mpaa
+        else:
+            rating = 'NR'
+        tags = {'%TITLE%': self.title,
+                '%FN%': fn,
+                '%EXT%': ext,
+                '%DT%': datetime.datetime.strftime(self.trailers[t].date, '%Y-%m%d'),
+                '%DTD%': datetime.datetime.strftime(self.trailers[t].urls[res].downloaded, '%Y-%m%d'),
+                '%RES%': res,
+                '%MPAA%': rating
+                }
+        new_fn = options.rename_mask
+
+        for tag in tags:
+            while 1:
+                _ = new_fn
+                new_fn = re.sub(tag, tags[tag], new_fn)
 
-            self.move_trailer(t, new_fn, res)
+                if _ == new_fn:
+                    #nothing left to change for this tag
+                    break
+
+        self.move_trailer(t, new_fn, res)
 
-            print "Saved to %s" % self.trailers[t].urls[res].local_path
+        print "Saved to %s" % self.trailers[t].urls[res].local_path
 
     def move_trailer(self, trailer_key, dest_fn, res):
         mkdir(options.destination)
         dest = sanitized_filename(os.path.splitext(dest_fn)[0], file_location=options.destination) + os.path.splitext(dest_fn)[1]
         dest = os.path.join(os.path.join(options.destination, dest))
         source = self.trailers[trailer_key].urls[res].local_path
+        digest = self.trailers[trailer_key].urls[res].hash
         if os.path.abspath(source).lower() != os.path.abspath(dest).lower():
-            self.trailers[trailer_key].urls[res].local_path = move_file(source, dest)
+            self.trailers[trailer_key].urls[res].local_path = move_file(source, dest, digest)
         else:
             self.trailers[trailer_key].urls[res].local_path = source
+            if content_index and ContentIndex.usable(digest):
+                content_index.add(source, digest)
 
     def _make_tag(self, text):
         return "#'%s'" % text
@@ -576,7 +2197,7 @@ class Movie():
         else:
             return tags2
 
-    def _parsexml(self, xml):
+    def _parsexml(self, xml, known_urls=()):
         ''' Get all the trailer attributes from the xml.
         '''
         self.apple_id = xml.attrib['id']
@@ -609,42 +2230,39 @@ class Movie():
         self.trailers[trailer_url] = Trailer(trailer_date, trailer_url, self.title)
 
         #Find any other trailers for the movie.
-        self.find_trailers(trailer_url)
+        self.find_trailers(trailer_url, known_urls)
 
-    def find_trailers(self, url):
-        urls = []
-        other_urls = self._build_other_trailer_urls(url)
-
-        for purl in other_urls:
-            #just checking for file existance, don't need to download
-            try:
-                opener = _get_trailer_opener(purl)
-            except urllib2.HTTPError:
-                continue
-            except:
-                print "Unknown error with additional trailer finder"
+    def find_trailers(self, url, known_urls=()):
+        ''' Looks for the movie's other trailers next to "url", skipping any
+            we already know about.  All the candidates are checked at once.
+        '''
+        other_urls = [u for u in self._build_other_trailer_urls(url)
+                      if u not in self.trailers and u not in known_urls]
 
-            headers = opener.info().headers
-            for header in headers:
-                #make sure file is a quicktime video
-                if header.lower().count('content-type:'):
-                    if header.lower().count('video/quicktime'):
-                        urls.append(purl)
+        #just checking for file existance, don't need to download
+        found = probe_urls(other_urls)
+        urls = [purl for purl in other_urls if found[purl]]
 
         for u in urls:
-            if u not in self.trailers:
-                self.trailers[u] = Trailer(datetime.datetime.today(), u, self.title)
+            self.trailers[u] = Trailer(datetime.datetime.today(), u, self.title)
+
+    def _build_other_trailer_urls(self, url, ahead=None):
+        ''' Apple numbers a movie's trailers tlr1, tlr2 and so on, and lists
+            one of them.  Returns the urls every earlier trailer would have,
+            plus the next "ahead" (defaults to --probe-ahead) in case newer
+            ones are up that the listing doesn't mention yet.
+        '''
+        if ahead is None:
+            ahead = options.probe_ahead
 
-    def _build_other_trailer_urls(self, url):
-        potential_urls = []
         try:
-            trailer_number = int(re.search(r"tlr(?P<num>\d)", url).group('num'))
+            trailer_number = int(re.search(r"tlr(?P<num>\d+)", url).group('num'))
         except:
             return []
-        if trailer_number == 1:
-            return []
-        for i in range(1, trailer_number-1):
-            potential_urls.append(re.sub(r"tlr\d", "tlr%s" % i, url))
+
+        potential_urls = []
+        for i in range(1, trailer_number) + range(trailer_number + 1, trailer_number + ahead + 1):
+            potential_urls.append(re.sub(r"tlr\d+", "tlr%s" % i, url))
 
         return potential_urls
 
@@ -659,31 +2277,29 @@ class Movie():
 
     def _getimdb(self):
         ''' A lot of movies don't have an MPAA rating when they're posted to Apple.
-            Here we try to get their current rating from IMDb.
+            Here we try to get their current rating from IMDb.  Raises IOError
+            if we can't reach IMDb, in which case the movie is still pending.
         '''
-        if self.mpaa.lower() == 'not yet rated':
-            i = imdb.IMDb()
-            #try to access imdb up to 3 times
-            for x in range(3):
-                try:
-                    i_results = i.search_movie(self.title.lower())
-                    fail = False
-                    break
-                except:
-                    fail = True
-                    time.sleep(1)
-
-            if fail:
-                print "Failed to connect to imdb"
-                self.mpaa = None
-                return
-
+        if self.imdb_pending:
             if self.release_date:
                 year = self.release_date.year
             else:
                 #guess at the year by adding 12 weeks to today
                 year = (datetime.datetime.today() + datetime.timedelta(weeks=12)).year
 
+            if imdb_cache:
+                cached, rating = imdb_cache.get(self.title, year)
+                if cached:
+                    self.mpaa = rating
+                    self.imdb_pending = False
+                    return
+
+            i = imdb_client()
+            try:
+                i_results = i.search_movie(self.title.lower())
+            except Exception, e:
+                raise IOError("Failed to connect to imdb: %s" % e)
+
             i_result = None
 
             #Use an exact title and year match to make sure we've found the
@@ -706,7 +2322,11 @@ class Movie():
                 cert_list = ["NC-17", "R", "PG-13", "PG", "G", "UNRATED"]
 
                 #Have to update the movie object IMDbPy gave us so it contains rating info
-                i.update(i_result)
+                try:
+                    i.update(i_result)
+                except Exception, e:
+                    raise IOError("Failed to connect to imdb: %s" % e)
+                self.mpaa = None
                 if i_result.has_key('certificates'):
                     usa_certs = []
                     for cert in i_result['certificates']:
@@ -722,8 +2342,6 @@ class Movie():
                     #Sort via cert_list and take least-restrictive rating
                     if len(usa_certs) > 0:
                         self.mpaa = sorted(usa_certs, key=cert_list.index)[-1]
-                    else:
-                        self.mpaa = None
 
                 if not self.mpaa and i_result.has_key('mpaa'):
                     #Some movies have the mpaa field such as "Rated R for sexuality."
@@ -732,8 +2350,10 @@ class Movie():
                         self.mpaa = re.search(r"(?P<rating>[a-zA-Z0-9-]+) for", i_result['mpaa']).group('rating').upper()
                     except:
                         self.mpaa = None
-                else:
-                    self.mpaa = None
+
+            self.imdb_pending = False
+            if imdb_cache:
+                imdb_cache.store(self.title, year, self.mpaa)
 
     def __str__(self):
         if self.release_date:
@@ -750,30 +2370,35 @@ class Movie():
     def __repr__(self):
         return "<Movie: %s>" % self.title
 
-class Trailer():
-    def __init__(self, date, url, movie_title, potential_res=None):
+class Trailer(_Slotted):
+    __slots__ = ('movie_title', 'date', 'url', '_rez_fetched', 'urls')
+    potential_res = POTENTIAL_RES
+
+    def __init__(self, date=None, url=None, movie_title=None):
         self.movie_title = movie_title
         self.date = date
         self.url = url
-        if not potential_res:
-            self.potential_res = ['1080p', '720p', '480p', '640w', '480', '320']
         self._rez_fetched = datetime.datetime.today()
         self.urls = {}
 
-    def download(self, res, force):
+    def __setstate__(self, state):
+        _Slotted.__setstate__(self, state)
+        self.urls = dict((intern(res), self.urls[res]) for res in self.urls)
+
+    def download(self, res, force, throttle=None, segments=None):
         res_choice = self.choose_res(res)
         if not res_choice:
             print "Can't choose res for %s" % self.movie_title
             return None
         if res_choice:
-            self.urls[res].download(force)
+            self.urls[res].download(force, segments=segments, throttle=throttle)
             return True
         else:
             print "%s is not an available resolution" % res
 
     def build_urls(self, rezs):
         for res in rezs:
-            self.urls[res] = TrailerResUrl(res, self.url)
+            self.urls[intern(res)] = TrailerResUrl(res, self.url)
 
     def choose_res(self, target_res, go_higher=False, exact=True):
         if exact:
@@ -810,40 +2435,29 @@ class Trailer():
             url = ''
         return url
 
-    #treat method as attribute to save on calls to apple.com
-    @property
-    def available_res(self):
-        #go fetch available resolutions only if it's been more than 6 days
-        if (datetime.datetime.today() - self._rez_fetched).days > 6 or len(self.urls) == 0:
-            rezs = []
-            for res in self.potential_res:
-                #build the url for the resolution
-                url = self.res_url(res)
-                if not url:
-                    continue
-
-                #just checking for file existance, don't need to download
-                try:
-                    opener = _get_trailer_opener(url)
-                except urllib2.HTTPError:
-                    continue
-                except:
-                    print "Unknown error with trailer resolution finder (http)"
+    def res_stale(self):
+        ''' We only go fetch available resolutions if it's been more than 6
+            days or we don't know of any yet.
+        '''
+        return (datetime.datetime.today() - self._rez_fetched).days > 6 or len(self.urls) == 0
 
-                headers = opener.info().headers
-                for header in headers:
-                    #make sure file is a quicktime video
-                    if header.lower().count('content-type:'):
-                        if header.lower().count('video/quicktime'):
-                            rezs.append(res)
+    def set_available_res(self, rezs):
+        ''' Record the result of a resolution check done by
+            fetch_available_res().
+        '''
+        #store datetime for cache purposes
+        self._rez_fetched = datetime.datetime.today()
 
-            #store datetime for cache purposes
-            self._rez_fetched = datetime.datetime.today()
+        #populate our list of urls for this trailer
+        self.build_urls(rezs)
 
-            #populate our list of urls for this trailer
-            self.build_urls(rezs)
+        return rezs
 
-            return rezs
+    #treat method as attribute to save on calls to apple.com
+    @property
+    def available_res(self):
+        if self.res_stale():
+            return fetch_available_res([self])[self]
         else:
             return self.urls.keys()
 
@@ -853,16 +2467,37 @@ class Trailer():
     def __repr__(self):
         return self.__str__()
 
-class TrailerResUrl():
-    def __init__(self, res, master_url):
+class _RangeIgnored(Exception):
+    ''' Raised when a server answers a ranged request with the whole file.
+    '''
+    pass
+
+class TrailerResUrl(_Slotted):
+    __slots__ = ('master_url', 'res', 'url', 'downloaded', 'size',
+                 'local_path', 'hash', 'expected_size', 'etag', 'last_modified')
+    _defaults = {'downloaded': False, 'size': 0}
+
+    #Files smaller than this aren't worth splitting into segments
+    segment_min_size = 8 * 1024 * 1024
+
+    def __init__(self, res=None, master_url=None):
         self.master_url = master_url
-        self.res = res
+        self.res = res and intern(res)
         self.url = self.build_url()
         self.downloaded = False
         self.size = 0
         self.local_path = None
         self.hash = None
 
+        #Resume info for partial downloads
+        self.expected_size = None
+        self.etag = None
+        self.last_modified = None
+
+    def __setstate__(self, state):
+        _Slotted.__setstate__(self, state)
+        self.res = self.res and intern(self.res)
+
     def build_url(self):
         try:
             url = re.sub(re.search(r"_h(?P<res>.*)\.mov", self.master_url).group('res'), self.res, self.master_url)
@@ -870,23 +2505,213 @@ class TrailerResUrl():
             url = ''
         return url
 
-    def download(self, force):
+    def download(self, force, bufsize=None, segments=None, throttle=None):
+        ''' Download this resolution of the trailer to the current directory.
+            The file is streamed to disk "bufsize" bytes at a time (defaults
+            to --buffer-size).
+
+            Data goes to a .part file until the download is complete.  If a
+            .part file is left over from an earlier attempt, we ask the server
+            for just the rest of the file, as long as the file on the server
+            hasn't changed since then.
+
+            Otherwise, if "segments" (defaults to --segments) is more than 1
+            and the file is big enough, it's fetched over that many
+            connections at once.
+
+            "throttle" is an optional TokenBucket to limit download speed.
+        '''
         if self.downloaded and not force:
             print "already downloaded"
             return
+        if not bufsize:
+            bufsize = options.buffer_size * 1024
+        if not segments:
+            segments = options.segments
         self.local_path = os.path.abspath(self.filename(self.url))
         if not fake:
-            opener = _get_trailer_opener(self.url)
-
-            f = open(self.local_path, 'wb')
-            f.write(opener.read())
-            f.close()
+            part_path = self.local_path + '.part'
+            try:
+                if segments > 1 and not self._load_journal(part_path):
+                    try:
+                        self._download_segments(part_path, segments, bufsize, throttle)
+                    except _RangeIgnored:
+                        print "Server doesn't support segmented downloads, using a single connection"
+                        self._discard_part(part_path)
+                        self._download_part(part_path, bufsize, throttle)
+                else:
+                    self._download_part(part_path, bufsize, throttle)
+            except urllib2.HTTPError, e:
+                if e.code != 416:
+                    raise
+                #The server can't give us the range we asked for, so whatever
+                #we have is no good.  Start over.
+                self._discard_part(part_path)
+                self._download_part(part_path, bufsize, throttle)
+
+            if os.path.isfile(self.local_path):
+                os.remove(self.local_path)
+            os.rename(part_path, self.local_path)
+            self._discard_part(part_path)
         else:
             open(self.local_path, 'w').close()
         self.downloaded = datetime.datetime.today()
         self.hash = hash_file(self.local_path)
         self.size = os.path.getsize(self.local_path)
 
+    def _download_part(self, part_path, bufsize, throttle=None):
+        ''' Fetch the trailer into part_path, resuming from what's already
+            there if we can.
+        '''
+        offset = 0
+        headers = {}
+        if self._load_journal(part_path) and os.path.isfile(part_path) and (self.etag or self.last_modified):
+            offset = os.path.getsize(part_path)
+            if offset:
+                headers['Range'] = 'bytes=%s-' % offset
+                #If-Range makes the server send the whole file instead if it
+                #has changed since our partial copy was made
+                headers['If-Range'] = self.etag or self.last_modified
+
+        opener = _get_trailer_opener(self.url, headers=headers)
+        try:
+            info = opener.info()
+            if offset and opener.getcode() == 206:
+                print "Resuming %s at %s bytes" % (os.path.basename(self.local_path), offset)
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+
+            length = info.getheader('Content-Length')
+            if length:
+                self.expected_size = offset + int(length)
+            else:
+                self.expected_size = None
+            self.etag = info.getheader('ETag')
+            self.last_modified = info.getheader('Last-Modified')
+            self._save_journal(part_path)
+
+            f = open(part_path, mode)
+            try:
+                _copy_stream(opener, f, bufsize, throttle)
+            finally:
+                f.close()
+        finally:
+            opener.close()
+
+        size = os.path.getsize(part_path)
+        if self.expected_size is not None and size != self.expected_size:
+            raise IOError("Incomplete download of %s (%s of %s bytes), run again to resume" % (self.url, size, self.expected_size))
+
+    def _download_segments(self, part_path, segments, bufsize, throttle=None):
+        ''' Fetch the trailer into part_path over several connections, each
+            downloading its own byte range straight into its place in the file.
+
+            Falls back to _download_part() for files that are too small to be
+            worth it.  Raises _RangeIgnored if the server won't do ranges.
+        '''
+        opener = _get_trailer_opener(self.url, method='HEAD')
+        info = opener.info()
+        opener.close()
+
+        length = info.getheader('Content-Length')
+        if not length or info.getheader('Accept-Ranges', '').lower() != 'bytes':
+            raise _RangeIgnored()
+        size = int(length)
+        if size < self.segment_min_size:
+            self._download_part(part_path, bufsize, throttle)
+            return
+        etag = info.getheader('ETag')
+        last_modified = info.getheader('Last-Modified')
+
+        #No journal is written for a segmented download since the .part file
+        #has holes in it until every segment is done.
+        f = open(part_path, 'wb')
+        f.truncate(size)
+        f.close()
+
+        seg_size = size / segments + 1
+        ranges = [(start, min(start + seg_size, size) - 1) for start in range(0, size, seg_size)]
+
+        #Once one segment fails the others stop too, and they've all closed
+        #the .part file before we return, since download() may delete it
+        cancel = threading.Event()
+
+        def fetch(byte_range):
+            start, end = byte_range
+            headers = {'Range': 'bytes=%s-%s' % (start, end)}
+            if etag or last_modified:
+                headers['If-Range'] = etag or last_modified
+            try:
+                opener = _get_trailer_opener(self.url, headers=headers)
+                try:
+                    if opener.getcode() != 206:
+                        raise _RangeIgnored()
+                    f = open(part_path, 'r+b')
+                    try:
+                        f.seek(start)
+                        copied = _copy_stream(opener, f, bufsize, throttle, cancel)
+                    finally:
+                        f.close()
+                finally:
+                    opener.close()
+                if copied != end - start + 1:
+                    raise IOError("Incomplete segment %s-%s of %s" % (start, end, self.url))
+            except:
+                cancel.set()
+                raise
+
+        _thread_map(fetch, ranges, len(ranges))
+
+        self.expected_size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def _journal_path(self, part_path):
+        return part_path + '.journal'
+
+    def _save_journal(self, part_path):
+        ''' Record what we know about the file we're downloading next to the
+            .part file, so an interrupted download can be resumed on a later
+            run even if we never got to save our state to the database.
+        '''
+        journal = {'url': self.url,
+                   'expected_size': self.expected_size,
+                   'etag': self.etag,
+                   'last_modified': self.last_modified}
+        f = open(self._journal_path(part_path), 'w')
+        try:
+            json.dump(journal, f)
+        finally:
+            f.close()
+
+    def _load_journal(self, part_path):
+        ''' Pick up the resume info saved by _save_journal().  Returns True
+            if there was any.
+        '''
+        try:
+            f = open(self._journal_path(part_path))
+            try:
+                journal = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        if journal.get('url') != self.url:
+            return False
+        self.expected_size = journal.get('expected_size')
+        #json gives us unicode, but these go back out in http headers
+        for attrib in ('etag', 'last_modified'):
+            if journal.get(attrib):
+                setattr(self, attrib, str(journal[attrib]))
+        return True
+
+    def _discard_part(self, part_path):
+        for path in (part_path, self._journal_path(part_path)):
+            if os.path.isfile(path):
+                os.remove(path)
+
     def filename(self, url):
         orig = os.path.basename(url)
         ext = os.path.splitext(orig)[1][1:]
@@ -900,6 +2725,175 @@ class TrailerResUrl():
     def __repr__(self):
         return self.__str__()
 
+def download_tester():
+    ''' Checks TrailerResUrl.download() against a local HTTP server serving
+        made up .mov files: segmented downloads, falling back to a single
+        connection when the server won't do ranges, stopping every segment
+        when one fails, and resuming from a .part file and its journal.
+
+            python -c "import atd; atd.download_tester()"
+    '''
+    import BaseHTTPServer
+    import SocketServer
+    import tempfile
+    global fake
+    fake = False
+
+    ipass = 0
+    print "Starting download_tester()..."
+    data = ''.join([chr(i % 251) for i in range(300 * 1024)])
+    etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        #what the server does with Range: 'ranges', 'ignore' (answer with
+        #the whole file) or 'none' (also don't send Accept-Ranges)
+        mode = 'ranges'
+        #ranged requests starting here get a 500, and the others are sent
+        #slowly so they're still going when it fails
+        fail_at = None
+        requests = []
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.serve(False)
+
+        def do_GET(self):
+            self.serve(True)
+
+        def serve(self, body):
+            byte_range = self.headers.getheader('Range')
+            Handler.requests.append((self.command, byte_range))
+            start, end = 0, len(data) - 1
+            code = 200
+            if byte_range and self.mode == 'ranges' and self.headers.getheader('If-Range', etag) == etag:
+                m = re.match(r"bytes=(\d+)-(\d*)", byte_range)
+                start = int(m.group(1))
+                if m.group(2):
+                    end = int(m.group(2))
+                code = 206
+                if start == self.fail_at:
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+            self.send_response(code)
+            self.send_header('Content-Type', 'video/quicktime')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('ETag', etag)
+            if self.mode != 'none':
+                self.send_header('Accept-Ranges', 'bytes')
+            if code == 206:
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+            self.end_headers()
+            if not body:
+                return
+            try:
+                for pos in range(start, end + 1, 4096):
+                    if self.fail_at is not None:
+                        time.sleep(0.1)
+                    self.wfile.write(data[pos:min(pos + 4096, end + 1)])
+            except socket.error:
+                pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            #we hang up on the server on purpose
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    base = 'http://127.0.0.1:%s/' % server.server_address[1]
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    min_size = TrailerResUrl.segment_min_size
+    TrailerResUrl.segment_min_size = 64 * 1024
+
+    def fetch(name, mode='ranges', fail_at=None, segments=3):
+        Handler.mode = mode
+        Handler.fail_at = fail_at
+        Handler.requests = []
+        url = TrailerResUrl()
+        url.url = base + name
+        url.download(True, bufsize=8192, segments=segments)
+        return open(url.local_path, 'rb').read() == data
+
+    try:
+        print "     Trying a segmented download ..."
+        ok = fetch('ranged_h1080p.mov')
+        ranged = [r for r in Handler.requests if r[0] == 'GET' and r[1]]
+        if ok and len(ranged) == 3:
+            print "passed test: segmented download."
+            ipass += 1
+        else:
+            print "TEST FAIL!   segmented download.", Handler.requests
+
+        print "     Trying a server that ignores Range ..."
+        if fetch('ignored_h1080p.mov', mode='ignore'):
+            print "passed test: fallback when Range is ignored."
+            ipass += 1
+        else:
+            print "TEST FAIL!   fallback when Range is ignored."
+
+        print "     Trying a server without Accept-Ranges ..."
+        ok = fetch('noranges_h1080p.mov', mode='none')
+        if ok and not [r for r in Handler.requests if r[1]]:
+            print "passed test: fallback without Accept-Ranges."
+            ipass += 1
+        else:
+            print "TEST FAIL!   fallback without Accept-Ranges.", Handler.requests
+
+        print "     Trying a segment that fails ..."
+        #the last segment fails, and the others would take a few seconds
+        started = time.time()
+        try:
+            fetch('failing_h1080p.mov', fail_at=(len(data) / 3 + 1) * 2)
+            failed = False
+        except urllib2.HTTPError:
+            failed = True
+        if failed and time.time() - started < 2:
+            print "passed test: failed segment stops the others."
+            ipass += 1
+        else:
+            print "TEST FAIL!   failed segment stops the others."
+
+        print "     Trying to resume from a .part file ..."
+        url = TrailerResUrl()
+        url.url = base + 'resumed_h1080p.mov'
+        part_path = os.path.abspath(url.filename(url.url)) + '.part'
+        f = open(part_path, 'wb')
+        f.write(data[:100000])
+        f.close()
+        url.expected_size = len(data)
+        url.etag = etag
+        url._save_journal(part_path)
+        ok = fetch('resumed_h1080p.mov')
+        if ok and Handler.requests == [('GET', 'bytes=100000-')] and not os.path.exists(part_path):
+            print "passed test: resume from .part and .journal."
+            ipass += 1
+        else:
+            print "TEST FAIL!   resume from .part and .journal.", Handler.requests
+    finally:
+        TrailerResUrl.segment_min_size = min_size
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+        server.shutdown()
+
+    print "----------------------------------------------------------------"
+    if ipass == 5:
+        #increment if you added a test
+        print " *** download_tester: PASSED ***"
+    else:
+        print " !!! download_tester: FAILED!"
+
 
 options = _options()
 
@@ -909,8 +2903,32 @@ if __name__ == "__main__":
     else:
         fake = False
     db = db_conx('atd.db')
-    if options.flush:
-        db.delete("*", "movies")
+    content_index = ContentIndex(db)
+    imdb_cache = ImdbCache(db)
+    probe_cache = ProbeCache(db)
+
+    if options.benchmark == 'codecs':
+        benchmark_codecs(db)
+        sys.exit()
+    elif options.benchmark == 'hash':
+        benchmark_hash(db)
+        sys.exit()
+
+    #Use one connection and one transaction for the whole run instead of
+    #committing every statement.  Whatever got done is committed even if the
+    #run dies, so we remember what we've downloaded so far.
+    db.hold()
+    try:
+        if options.flush:
+            db.delete("*", "movies")
+
+        if options.pipeline and not options.redownload:
+            run_pipeline(db, options.respref)
+        else:
+            update_movies(db)
+            download_trailers(db, options.respref)
+    finally:
+        checkpoint(db, release=True)
 
-    update_movies(db)
-    download_trailers(db, options.respref)
\ No newline at end of file
+    stats = http_pool.stats()
+    print "HTTP requests: %(requests)s, connections reused: %(reused)s, opened: %(new)s, idle evicted: %(evicted)s" % stats
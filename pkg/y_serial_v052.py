@@ -322,6 +322,9 @@ DEBUG    = False
 import sqlite3 as ysql
 #                 ^ for portability to another SQL database.
 
+import threading
+#      ^ to share a held connection safely among threads (see Base.hold).
+
 import pprint
 #  pretty print to Display nested arbitrary Python data structures.
 
@@ -350,15 +353,77 @@ compress_level  = 7
 #       1 is fastest and produces the least compression, 
 #       9 is slowest and produces the greatest compression. 
 
+import time
+#      ^ for benchcodecs.
+
+#       __________ CODECS for the pickled
+
+#  A codec compresses the pickled string on the way into the database, 
+#  and is identified by a one byte tag placed in front of what it writes, 
+#  so each row records how to undo it.  Every zlib stream already starts 
+#  with the byte 'x', which serves as the tag for zlib:  thus zlib rows 
+#  are written exactly as before, and rows from older versions still load.
+#
+#  Faster (but larger) LZ-class codecs are used when their modules exist.
+
+codecs = {}
+#        ^ name -> ( tag, compress(pickled, level), decompress(string) )
+
+def addcodec( name, tag, compress, decompress ):
+     '''Register a codec under name with its one byte tag.'''
+     codecs[name] = ( tag, compress, decompress )
+
+addcodec( 'zlib', 'x', zlib.compress, zlib.decompress )
+addcodec( 'none', '\x00', lambda s, level: s, lambda s: s )
+
+try:
+     import lz4.block as lz4
+     addcodec( 'lz4', '\x01', lambda s, level: lz4.compress(s), lz4.decompress )
+except ImportError:
+     pass
+
+try:
+     import snappy
+     addcodec( 'snappy', '\x02', lambda s, level: snappy.compress(s), 
+                                  snappy.uncompress )
+except ImportError:
+     pass
+
+compressor = 'zlib'
+#            ^ the codec used by pzdumps, see setcodec.
+
+def setcodec( name=None, level=None, protocol=None ):
+     '''Choose the codec, compress level and pickle protocol for pzdumps.'''
+     global compressor, compress_level, pickle_protocol
+     if name is not None:
+          if name not in codecs:
+               raise ValueError( "unknown codec: %s" % name )
+          compressor = name
+     if level is not None:
+          compress_level = level
+     if protocol is not None:
+          pickle_protocol = protocol
+
 def pzdumps( obj ):
      '''Pickle object, then compress the pickled.'''
-     return zlib.compress( yPickle.dumps(obj, pickle_protocol), compress_level)
+     tag, compress, decompress = codecs[compressor]
+     pz = compress( yPickle.dumps(obj, pickle_protocol), compress_level )
+     if compressor == 'zlib':
+          return pz
+          #      ^already starts with its tag.
+     return tag + pz
      #      as binary string.
 
 def pzloads( pzob ):
      '''Inverse of pzdumps:  decompress pz object, then unpickle.'''
-     return yPickle.loads( zlib.decompress( pzob ) )  
-     #              ^auto-detects pickle protocol.
+     tag = pzob[:1]
+     if tag == 'x':
+          return yPickle.loads( zlib.decompress( pzob ) )
+     for name in codecs:
+          if codecs[name][0] == tag:
+               return yPickle.loads( codecs[name][2]( pzob[1:] ) )
+     raise ValueError( "no codec for tag %r (module not installed?)" % tag )
+     #              ^pickle protocol is auto-detected by loads.
 
 
 
@@ -395,54 +460,165 @@ class Base:
      #  an exception.  Increase the wait if a very large amount of objects 
      #  is routinely inserted during a single session.
 
-     def __init__( self, db=db0 ):
+     PRAGMAS  = {}
+     #          ^ default SQLite PRAGMA settings applied on every connection, 
+     #  e.g. { 'journal_mode': 'WAL', 'synchronous': 'NORMAL' }.  
+     #  Write-ahead logging (WAL) lets readers carry on while a writer 
+     #  holds its lock, instead of blocking behind it.  Others of interest: 
+     #  cache_size, mmap_size, temp_store.  See sqlite.org/pragma.html
+     #  Names and values go into the SQL as is, so keep them trusted.
+
+     def __init__( self, db=db0, pragmas=None ):
           '''Set path to database for all instances; db0 is default.'''
           self.db = db
+          self.pragmas = dict( self.PRAGMAS )
+          if pragmas:
+               self.pragmas.update( pragmas )
+               #  ^ per instance PRAGMA settings override the defaults.
+          self.con    = None
+          self.holds  = 0
+          self.tables = []
+          self.lock   = threading.RLock()
+          #  ^ see hold for these.
+
+     def connect( self ):
+          '''Open a new connection to the database.'''
+          con = ysql.connect( self.db,        timeout = self.TIMEOUT, 
+                                      isolation_level = self.TRANSACT,
+                                    check_same_thread = False )
+          #                        ^ a held connection may be shared by 
+          #                          threads; self.lock serializes them.
+          for name, value in self.pragmas.items():
+               con.execute( 'PRAGMA %s = %s' % (name, value) )
+          return con
+
+     #       __________ HOLD one connection for a whole session   ___ATTN___
+     #
+     #  Normally every call connects, commits, and closes, which means a 
+     #  sync to disk for every single write.  Instead a session can hold 
+     #  one connection open so that all of its writes join a single 
+     #  transaction, committed once at the end:
+     #
+     #       with demo:
+     #            for obj in lots:
+     #                 demo.insert( obj, '#batch', 'goldfinger' )
+     #
+     #  The with-block commits on success, and rolls back on an exception.
+     #  Or call hold and release explicitly (these nest), and commit for 
+     #  a checkpoint along the way.  While held, the write lock is kept 
+     #  from the first write until commit, so other writers must wait.
+
+     def hold( self ):
+          '''Keep one connection open for all calls until release.'''
+          self.lock.acquire()
+          try:
+               if not self.holds:
+                    self.con = self.connect()
+               self.holds += 1
+          finally:
+               self.lock.release()
+
+     def commit( self ):
+          '''Commit the writes so far of a held connection.'''
+          self.lock.acquire()
+          try:
+               if self.con:
+                    self.con.commit()
+          finally:
+               self.lock.release()
+
+     def release( self, commit=True ):
+          '''Undo one hold; the last one commits (or rolls back) and closes.'''
+          self.lock.acquire()
+          try:
+               self.holds -= 1
+               if not self.holds:
+                    try:
+                         if commit:
+                              self.con.commit()
+                         else:
+                              self.con.rollback()
+                    finally:
+                         self.con.close()
+                         self.con    = None
+                         self.tables = []
+          finally:
+               self.lock.release()
+
+     def __enter__( self ):
+          self.hold()
+          return self
+
+     def __exit__( self, exc_type, exc_value, traceback ):
+          self.release( commit = exc_type is None )
+          return False
 
      def proceed( self, sql, parlist=[[]] ):
           '''Connect, executemany, commit, then finally close.'''
+          #  ... or when a connection is held, just executemany on it.
+          self.lock.acquire()
           try:
-               con = ysql.connect( self.db,    timeout = self.TIMEOUT, 
-                                       isolation_level = self.TRANSACT )
-               cur = con.cursor()
-               cur.executemany( sql, parlist )
-               #        for an empty ^parameter list, use [[]].
-               con.commit()
-               #   ^MUST remember to commit! else the data is rolled back! 
-          except:
-               a = " !! Base.proceed did not commit. [Check db path.] \n"
-               b = "             Suspect busy after TIMEOUT,          \n"
-               c = "             tried this sql and parameter list:   \n"
-               raise IOError, "%s%s%s%s\n%s" % ( a, b, c, sql, parlist )
+               held = self.con
+               try:
+                    if held:
+                         con = held
+                    else:
+                         con = self.connect()
+                    cur = con.cursor()
+                    cur.executemany( sql, parlist )
+                    #        for an empty ^parameter list, use [[]].
+                    if not held:
+                         con.commit()
+                    #   ^MUST remember to commit! else the data is rolled back! 
+               except:
+                    a = " !! Base.proceed did not commit. [Check db path.] \n"
+                    b = "             Suspect busy after TIMEOUT,          \n"
+                    c = "             tried this sql and parameter list:   \n"
+                    raise IOError, "%s%s%s%s\n%s" % ( a, b, c, sql, parlist )
+               finally:
+                    cur.close()
+                    if not held:
+                         con.close()
+                         #   ^ very important to release lock for concurrency.
           finally:
-               cur.close()
-               con.close()
-               #   ^ very important to release lock for concurrency.
+               self.lock.release()
 
      def respond( self, klass, sql, parlist=[] ):
           '''Connect, execute select sql, get response dictionary.'''
+          self.lock.acquire()
           try:
-               con = ysql.connect( self.db,    timeout = self.TIMEOUT, 
-                                       isolation_level = self.TRANSACT )
-               cur = con.cursor()
-               response = {}
-               for tupler in cur.execute( sql, parlist ):
-                    self.responder( klass, tupler, response )
-               #         ^ to be defined in a subclass
-               #           (mostly to process output from subqueries).
-               #  con.commit() intentionally omitted.
-          except:
-               a = " !! Base.respond choked, probably because     \n"
-               b = "             object feels out of context.     \n"
-               c = "           Tried this sql and parameter list: \n"
-               raise IOError, "%s%s%s%s\n%s" % (a, b, c, sql, parlist)
+               held = self.con
+               try:
+                    if held:
+                         con = held
+                    else:
+                         con = self.connect()
+                    cur = con.cursor()
+                    response = {}
+                    for tupler in cur.execute( sql, parlist ):
+                         self.responder( klass, tupler, response )
+                    #         ^ to be defined in a subclass
+                    #           (mostly to process output from subqueries).
+                    #  con.commit() intentionally omitted.
+               except:
+                    a = " !! Base.respond choked, probably because     \n"
+                    b = "             object feels out of context.     \n"
+                    c = "           Tried this sql and parameter list: \n"
+                    raise IOError, "%s%s%s%s\n%s" % (a, b, c, sql, parlist)
+               finally:
+                    cur.close()
+                    if not held:
+                         con.close()
           finally:
-               cur.close()
-               con.close()
+               self.lock.release()
           return response
 
      def createtable( self, table=tab0 ):
           '''Columns created: key ID, unix time, notes, and pzblob.'''
+          if table in self.tables:
+               return
+               #  ^ already done during this hold.  This matters since
+               #    sqlite3 commits any open transaction before DDL.
           a = 'CREATE TABLE IF NOT EXISTS %s' % table
           b = '(kid INTEGER PRIMARY KEY, tunix INTEGER,'
           c = 'notes TEXT, pzblob BLOB)'
@@ -454,6 +630,8 @@ class Base:
           except IOError:
                if DEBUG:
                     print " :: createtable: table exists."
+          if self.con:
+               self.tables.append( table )
           #    createtable is designed to be harmless if it 
           #    left sitting in your script.
 
@@ -472,7 +650,8 @@ class Insertion( Base ):
           '''Pickle and compress sequence of annotated objects; insert.'''
           self.createtable( table ) 
           #    ^ serves also to check table's existence.
-          s  = "INSERT INTO %s " % table
+          s  = "INSERT INTO %s (kid, tunix, notes, pzblob)" % table
+          #                    ^named since Indexed may add columns.
           v  = "VALUES (null, strftime('%s','now'), ?, ?)"
           #                   ^SQLite's function for unix epoch time.
           sql = ' '.join([s, v])
@@ -570,6 +749,9 @@ class Answer( Base ):
           if klass == 'Answer':
                response[0] = tupler
                #        ^ we only expect a single answer.
+          if klass == 'Rows':
+               response[ len(response) ] = tupler
+               #        ^ raw rows keyed by their order, e.g. for PRAGMA.
           if klass == 'Subquery':
                kid, tunix, notes, pzblob  =  tupler
                obj = pzloads( pzblob )
@@ -734,6 +916,8 @@ class Deletion( Base, Util ):
      def droptable( self, table=Base.tab0 ):
           '''Delete a table: destroys its structure, indexes, data.'''
           sql = 'DROP TABLE %s' % table 
+          if table in self.tables:
+               self.tables.remove( table )
           try:
                self.proceed( sql ) 
           except:
@@ -970,7 +1154,110 @@ class Care( Answer, Deletion ):
 
 
 
-class Main( Annex, Oldest, Care ):
+class Indexed( Insertion, Latest ):
+     '''_______________ Dedicated indexed columns alongside notes'''
+     #  GLOB on notes must scan (and dicsub must unpickle) every matching
+     #  row.  When objects are routinely looked up by the same few keys,
+     #  give those keys columns of their own with SQLite indexes.
+     #  Rows inserted the usual way simply have NULL in those columns.
+     #
+     #       demo.addcolumns( ['agent', 'city'], 'goldfinger' )
+     #       demo.inindexed( 911, '#plan', {'agent': '007'}, 'goldfinger' )
+     #       demo.omaxcol( 'agent', '007', 'goldfinger' )
+     #
+     #  Column names cannot be parametized, so never let them come
+     #  from untrusted input.
+
+     def columns( self, table=Base.tab0 ):
+          '''List the column names of table.'''
+          response = self.respond( 'Rows', 'PRAGMA table_info(%s)' % table )
+          return [ response[i][1] for i in range( len(response) ) ]
+
+     def addcolumns( self, columns, table=Base.tab0 ):
+          '''Add indexed columns to table, unless they already exist.'''
+          self.createtable( table )
+          existing = self.columns( table )
+          for col in columns:
+               if col not in existing:
+                    self.proceed( 'ALTER TABLE %s ADD COLUMN %s' % (table, col) )
+               a = 'CREATE INDEX IF NOT EXISTS %s_%s' % (table, col)
+               self.proceed( '%s ON %s (%s)' % (a, table, col) )
+
+     def inindexed( self, obj, notes, colvals, table=Base.tab0 ):
+          '''Pickle and compress object; insert with notes and column values.'''
+          #    colvals is a dictionary of column name to value.
+          cols = colvals.keys()
+          s  = "INSERT INTO %s (tunix, notes, pzblob, %s) " % (table, 
+                                                       ', '.join(cols))
+          v  = "VALUES (strftime('%%s','now'), ?, ?, %s)" % ', '.join(
+                                                         ['?'] * len(cols))
+          sql = ' '.join([s, v])
+          parlist = [ notes, ysql.Binary(pzdumps(obj)) ]
+          parlist.extend( [ colvals[c] for c in cols ] )
+          self.proceed( sql, [ parlist ] )
+
+     def updatecols( self, kid, colvals, table=Base.tab0 ):
+          '''Set column values for the row with primary key kid.'''
+          cols = colvals.keys()
+          sets = ', '.join( [ '%s = ?' % c for c in cols ] )
+          sql  = 'UPDATE %s SET %s WHERE kid = ?' % (table, sets)
+          self.proceed( sql, [ [ colvals[c] for c in cols ] + [ kid ] ] )
+
+     def omaxcol( self, column, value, table=Base.tab0, POP=False ):
+          '''Get latest object whose column equals value (single blob read).'''
+          subquery = 'WHERE %s = ? ORDER BY kid DESC LIMIT 1' % column
+          return self.omaxsub( subquery, [value], table, POP )
+          #  Only that one row is decompressed and unpickled, 
+          #  and the index makes finding it a quick lookup.
+
+     def deletecol( self, column, value, table=Base.tab0 ):
+          '''Delete row(s) whose column equals value.'''
+          self.deletesub( 'WHERE %s = ?' % column, [value], table )
+
+     #       __________ LAZY rows: filter first, unpickle later
+     #
+     #  dicsub decompresses and unpickles every row it matches.  When 
+     #  most of those objects would be thrown away after a look at their 
+     #  columns, get lightweight Row handles instead, filter those, and 
+     #  then load only the objects which survive:
+     #
+     #       rows = demo.rowsub( 'WHERE city = ?', ['paris'], 
+     #                           ['agent'], 'goldfinger' )
+     #       objs = [ r.load() for r in rows if r.agent > '005' ]
+
+     def rowsub( self, subquery='', parlist=[], columns=[], table=Base.tab0 ):
+          '''Get Row handles matching subquery, without any unpickling.'''
+          cols = ', '.join( ['kid', 'tunix', 'notes'] + list(columns) )
+          sql  = 'SELECT %s FROM %s %s' % ( cols, table, subquery )
+          response = self.respond( 'Rows', sql, parlist )
+          return [ Row( self, table, columns, response[i] )
+                   for i in range( len(response) ) ]
+
+     def loadkid( self, kid, table=Base.tab0 ):
+          '''Get the object in the row with primary key kid.'''
+          return self.omaxsub( 'WHERE kid = ?', [kid], table )
+
+
+
+class Row:
+     '''_______________ Handle on a table row; object loaded on demand.'''
+     #  Attributes: kid, tunix, notes, plus one for each column 
+     #  requested from rowsub (so avoid columns named like those).
+
+     def __init__( self, base, table, columns, tupler ):
+          self.base  = base
+          self.table = table
+          self.kid, self.tunix, self.notes = tupler[:3]
+          for col, value in zip( columns, tupler[3:] ):
+               setattr( self, col, value )
+
+     def load( self ):
+          '''Decompress and unpickle the object of this row.'''
+          return self.base.loadkid( self.kid, self.table )
+
+
+
+class Main( Annex, Oldest, Care, Indexed ):
      '''_______________ Summary for use of a single database.'''
      pass
      #                  Base
@@ -984,6 +1271,7 @@ class Main( Annex, Oldest, Care ):
      #         Latest(Display)
      #  Oldest(Latest)
      #                                  Care(Answer, Deletion)
+     #                           Indexed(Insertion, Latest)
 
 
 
@@ -1743,6 +2031,95 @@ def tester( database=Base.db0 ):
      #  Test inweb separately since it requires an external website.
      #  2009-09-20 v0.22
      #     HTML from python.org appears fine with newlines preserved.
+     # ================================================================== 
+     I.droptable( 'ytest3' )
+     I.droptable( 'ytest4' )
+     print "     Trying setcodec and codec tags ..."
+     saved = ( compressor, compress_level, pickle_protocol )
+     I.insert( tmp2, 'codec zlib', 'ytest3' )
+     tags = { 'zlib': 'x' }
+     for name in ( 'none', 'lz4' ):
+          if name in codecs:
+               setcodec( name )
+               I.insert( tmp2, 'codec %s' % name, 'ytest3' )
+               tags[name] = codecs[name][0]
+     setcodec( *saved )
+     got5 = I.rowsub( "WHERE notes GLOB ?", ['codec *'], ['pzblob'], 'ytest3' )
+     if len(got5) == len(tags) and [ r for r in got5 
+                         if str(r.pzblob)[:1] != tags[r.notes[6:]] ] == []:
+          print "passed test: codec tags", sorted( tags )
+          ipass += 1
+     else:
+          print "TEST FAIL!   codec tags."
+     if [ r for r in got5 if r.load() != tmp2 ] == []:
+          print "passed test: old zlib row loads next to other codecs."
+          ipass += 1
+     else:
+          print "TEST FAIL!   mixed codec rows."
+     try:
+          setcodec( 'no-such-codec' )
+          print "TEST FAIL!   unknown codec accepted."
+     except ValueError:
+          print "passed test: unknown codec refused."
+          ipass += 1
+     #    --------------------------------
+     print "     Trying hold, commit and release ..."
+     J = Main( database )
+     I.hold()
+     I.insert( tmp3, 'held', 'ytest3' )
+     unseen = J.omaxsub( "WHERE notes = ?", ['held'], 'ytest3' )
+     I.commit()
+     seen = J.omaxsub( "WHERE notes = ?", ['held'], 'ytest3' )
+     I.release()
+     if unseen is None and seen == tmp3:
+          print "passed test: held writes show up at commit."
+          ipass += 1
+     else:
+          print "TEST FAIL!   hold and commit."
+     try:
+          with I:
+               I.insert( tmp3, 'rolled back', 'ytest3' )
+               raise ValueError( "abandon the with block" )
+     except ValueError:
+          pass
+     if I.omaxsub( "WHERE notes = ?", ['rolled back'], 'ytest3' ) is None:
+          print "passed test: with block rolled back on exception."
+          ipass += 1
+     else:
+          print "TEST FAIL!   with block rollback."
+     #    --------------------------------
+     print "     Trying indexed columns ..."
+     I.addcolumns( ['city', 'agent'], 'ytest4' )
+     I.addcolumns( ['city', 'agent'], 'ytest4' )
+     if [ c for c in I.columns('ytest4') if c in ('city', 'agent') ] == \
+                                                        ['city', 'agent']:
+          print "passed test: addcolumns."
+          ipass += 1
+     else:
+          print "TEST FAIL!   addcolumns."
+     I.inindexed( tmp1, 'spy one',   {'city': 'paris', 'agent': '007'}, 'ytest4' )
+     I.inindexed( tmp2, 'spy two',   {'city': 'paris', 'agent': '006'}, 'ytest4' )
+     I.inindexed( tmp3, 'spy three', {'city': 'rome',  'agent': '007'}, 'ytest4' )
+     if I.omaxcol( 'agent', '007', 'ytest4' ) == tmp3:
+          print "passed test: omaxcol gets the latest."
+          ipass += 1
+     else:
+          print "TEST FAIL!   omaxcol."
+     rows = I.rowsub( 'WHERE city = ?', ['paris'], ['agent'], 'ytest4' )
+     objs = [ r.load() for r in rows if r.agent > '006' ]
+     if len(rows) == 2 and objs == [tmp1]:
+          print "passed test: rowsub and Row.load."
+          ipass += 1
+     else:
+          print "TEST FAIL!   rowsub and Row.load."
+     I.deletecol( 'city', 'rome', 'ytest4' )
+     if I.omaxcol( 'agent', '007', 'ytest4' ) == tmp1:
+          print "passed test: deletecol."
+          ipass += 1
+     else:
+          print "TEST FAIL!   deletecol."
+     I.droptable( 'ytest3' )
+     I.droptable( 'ytest4' )
      print "----------------------------------------------------------------"
      print "DELETING rows older than 30 minutes from ytest."
      I.freshen( 0.0208, 'ytest' )
@@ -1753,7 +2130,7 @@ def tester( database=Base.db0 ):
      ipass += 1
      #  print "     (Note: copysub and copycomma v0.50 have passed inspection.)"
      print "COPYING table ytest to ytest2."
-     copy( '', 'ytest', 'ytest2' )
+     copy( '', 'ytest', 'ytest2', database, database )
      #     however, they are not necessarily identical for kids may differ.
      ipass += 1
      print "     Assert copy and fifo methods:", 
@@ -1772,7 +2149,7 @@ def tester( database=Base.db0 ):
      ipass += 1
      print "----------------------------------------------------------------"
      #  print "ipass =", ipass
-     if ipass == 19:
+     if ipass == 28:
           #      ^increment if you added a test ;-)
           print " *** tester    compiled: PASSED -- verify results above. ***"
      else:
@@ -1829,6 +2206,41 @@ def testfarm( dir=Farm.dir0, maxbarns=Farm.barns0, noobs=500 ):
           print " !!! testfarm   summary: FAILED! -- y_serial BROKEN."
 
 
+def benchcodecs( objs, protocols=(1, 2), rounds=3 ):
+     '''Time pzdumps/pzloads of objs for each codec; return result rows.'''
+     #  Each row:  ( codec, level, protocol, total bytes, 
+     #               dumps MB/s, loads MB/s )   where MB/s is measured 
+     #  against the size of the plain pickle, so rows compare fairly.
+     global compressor, compress_level, pickle_protocol
+     saved = ( compressor, compress_level, pickle_protocol )
+     settings = [ ('none', None), ('zlib', 1), ('zlib', 6), ('zlib', 9) ]
+     settings += [ (name, None) for name in sorted(codecs) 
+                   if name not in ('none', 'zlib') ]
+     results = []
+     try:
+          for protocol in protocols:
+               raw = sum([ len(yPickle.dumps(obj, protocol)) for obj in objs ])
+               mb  = rounds * raw / 1048576.0
+               for name, level in settings:
+                    setcodec( name, level or saved[1], protocol )
+                    start = time.time()
+                    for i in range( rounds ):
+                         pzs = [ pzdumps(obj) for obj in objs ]
+                    dumped = time.time() - start
+                    start = time.time()
+                    for i in range( rounds ):
+                         for pz in pzs:
+                              pzloads( pz )
+                    loaded = time.time() - start
+                    size = sum([ len(pz) for pz in pzs ])
+                    results.append(( name, level, protocol, size, 
+                                     mb / max(dumped, 1e-9), 
+                                     mb / max(loaded, 1e-9) ))
+     finally:
+          compressor, compress_level, pickle_protocol = saved
+     return results
+
+
 if __name__ == "__main__":
      print "\n  ::  THIS IS A MODULE for import -- not for direct execution! \n"
      raw_input('Enter something to get out: ')